@@ -1,9 +1,13 @@
 """
-system hash: 690fbcc140f83b0896fcb2ba5a53ac8c3a452668
+system hash: b3a6115f070adb58f1a6c9f5acd9cadbbf5d57b5
 
 You are going to create a bunch of plot images, upload to the server, and create a file ./genie_output/index.md that links to the images.
 
-Start by removing ./genie_output/index.md and creating the ./genie_output directory if needed.
+Create the ./genie_output directory if needed.
+
+The build is incremental. Keep a manifest at ./genie_output/manifest.json that records, for each output image, a hash of its inputs (the session asset ID, the plot name and the plotting parameters) and a hash of the PNG bytes that were uploaded, along with the uploaded URL. On a rerun, skip any session whose plots are all up to date without loading it, only render the plots whose input hash changed, and only upload the images whose bytes changed. If a plot fails, print the error and do not record it in the manifest, so that it is retried on the next run (failures may be transient, like network errors). Write the manifest after every session.
+
+Run the work as three overlapping stages. The main thread loads the data for each session and builds a plot spec for each plot to update: a dict with the numpy arrays and the plotting parameters, in the format described in helpers/render_figure.py. The specs are rendered to PNG bytes in a bounded pool of worker processes with `FigureRenderer(max_in_flight=8)` from helpers.render_figure (`renderer.submit(spec)` returns a future). The PNG bytes are uploaded in the background with upload_file_data_async, as described in the system instructions. Record a plot in the manifest only once its upload has finished, and wait for the renderer and flush_uploads() before exiting. Put the top-level code in a main() function, called under `if __name__ == "__main__":`, so that the worker processes can import the script.
 
 The files uploaded to the server will be as following
 
@@ -43,15 +47,15 @@ For each session in the Dandiset:
 * Plot all pupil radius acquisitions aligned to start time
 * Plot the ROI responses for the first acquisition for all ROIs on the same plot.
 
-Images should be side by side, not stacked. That means putting them in a div with display flex, as described in the system instructions. Use cache busting as shown with a short random string that is generated at the beginning of the script.
+Images should be side by side, not stacked. That means putting them in a div with display flex, as described in the system instructions. For cache busting, use the first 8 characters of the hash of the uploaded bytes, so that unchanged images keep the same URL.
 
 All images should be scaled to have a width of 300 pixels, while maintaining the aspect ratio.
 
 Print the progress to the console, so the user knows what is happening.
 
-At the end of every session, write the index.md, so the user may see the progress.
+At the end of every session, regenerate the whole index.md from the manifest (in the order of the sessions in the Dandiset), so the user may see the progress.
 
-Important: some of the pupil_radius_xxx arrays for certain acquisitions may be missing. Use a try/except block to catch the error and continue to the next acquisition.
+Important: some of the pupil_radius_xxx arrays for certain acquisitions may be missing. Use S.has_pupil_radius(acq_name) to skip those acquisitions. More generally, check which series exist with the has_* methods or S.get_availability(), as shown in the usage example, rather than catching exceptions.
 
 Important: the roi response series has different timestamps for different acquisitions within the same session.
 
@@ -60,157 +64,294 @@ Important: Do not show legends on the plots that involve multiple ROIs or multip
 """
 
 import os
+import json
+import hashlib
 import numpy as np
-import matplotlib.pyplot as plt
 from dandiset_001256_interface import load_session, get_dandiset_info
-from helpers.upload_file import upload_file_data
-from io import BytesIO
-import random
-import string
-
-# Generate a cache buster string
-def generate_cache_buster(length=5):
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
-
-# Function to upload a figure to the server
-def upload_figure(fig, url):
-    buf = BytesIO()
-    fig.savefig(buf, format="png", bbox_inches='tight', pad_inches=0)
-    buf.seek(0)
-    binary_data = buf.read()
-    upload_file_data(url, binary_data)
-
-# Prepare directories and index file
-output_dir = "./genie_output"
-index_path = os.path.join(output_dir, "index.md")
-if os.path.exists(index_path):
-    os.remove(index_path)
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-# Fetch information about the Dandiset and its sessions
-info = get_dandiset_info()
-sessions = info['sessions']
-
-# Create the main heading for the index file
-with open(index_path, 'a') as md_file:
-    md_file.write("# Dandiset 001256\n\n")
-
-# Iterate through each session
-for session in sessions:
-    session_id = session['session_id']
-    print(f"Processing session: {session_id}")
-
-    nwb_url = session['asset_url']
-    S = load_session(nwb_url=nwb_url)
-
-    acquisition_names = S.get_acquisition_names()
-
-    # Prepare paths and headings
-    session_path = f"dandi/dandiset-001256/genie/sessions/{session_id}"
-    session_heading = f"## {session_id}\n\n"
-    
-    with open(index_path, 'a') as md_file:
-        md_file.write(session_heading)
-
-    # Create plots and upload them
-    plot_urls = []
-    
-    # Plot a single frame of the pupil video
-    try:
-        pupil_video = S.get_pupil_video("000")
-        frame = pupil_video.get_frame(10)
-        plt.figure(figsize=(6, 6))
-        plt.imshow(frame, cmap='gray')
-        plt.title("Pupil Video Frame")
-        plt.axis('off')
-        cache_buster = generate_cache_buster()
-        pupil_video_url = f"https://lindi.neurosift.org/tmp/{session_path}/pupil_video_single_frame.png?cb={cache_buster}"
-        plot_urls.append(pupil_video_url)
-        upload_figure(plt, pupil_video_url)
-        plt.clf()
-
-        # Plot a single frame of the two-photon video
-        two_photon_series = S.get_two_photon_series("000")
-        frame = two_photon_series.get_frame(10)
-        plt.figure(figsize=(6, 6))
-        plt.imshow(frame, cmap='gray')
-        plt.title("Two-photon Video Frame")
-        plt.axis('off')
-        cache_buster = generate_cache_buster()
-        two_photon_url = f"https://lindi.neurosift.org/tmp/{session_path}/two_photon_video_single_frame.png?cb={cache_buster}"
-        plot_urls.append(two_photon_url)
-        upload_figure(plt, two_photon_url)
-        plt.clf()
-
-        # Plot the average pupil response across all acquisitions
-        pupil_radius_data = []
-        first_timestamps = None
-        for acq_name in acquisition_names:
-            try:
-                pupil_radius = S.get_pupil_radius(acq_name)
-                if first_timestamps is None:
-                    first_timestamps = pupil_radius.get_timestamps()
-                pupil_radius_data.append(np.interp(first_timestamps, pupil_radius.get_timestamps() - pupil_radius.starting_time, pupil_radius.get_data()))
-            except Exception as e:
+from helpers.upload_file import upload_file_data_async, flush_uploads
+from helpers.render_figure import FigureRenderer
+
+# Bump this when the plotting code changes in a way that should invalidate all outputs
+PIPELINE_VERSION = 2
+
+# The plots for each session, with their plotting parameters
+PLOTS = {
+    "pupil_video_single_frame": {"acquisition": "000", "frame_index": 10, "figsize": [6, 6], "title": "Pupil Video Frame"},
+    "two_photon_video_single_frame": {"acquisition": "000", "frame_index": 10, "figsize": [6, 6], "title": "Two-photon Video Frame"},
+    "average_pupil_response": {"figsize": [6, 4], "title": "Average Pupil Response"},
+    "pupil_radius_acquisitions_aligned": {"figsize": [6, 4], "title": "Pupil Radius Aligned to Start Time"},
+    "roi_responses_first_acquisition": {"figsize": [6, 4], "title": "ROI Responses First Acquisition"},
+}
+
+
+def compute_hash(x):
+    if isinstance(x, bytes):
+        return hashlib.sha1(x).hexdigest()
+    return hashlib.sha1(json.dumps(x, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def compute_input_hash(asset_id, plot_name):
+    return compute_hash({
+        "pipeline_version": PIPELINE_VERSION,
+        "asset_id": asset_id,
+        "plot_name": plot_name,
+        "params": PLOTS[plot_name],
+    })
+
+
+# Each of the following loads the data for a plot and returns a plot spec,
+# which is rendered to png in a worker process (see helpers/render_figure.py)
+
+def video_frame_spec(video, params):
+    return {
+        "kind": "image",
+        "image": video.get_frame(params["frame_index"]),
+        "cmap": "gray",
+        "figsize": params["figsize"],
+        "title": params["title"],
+    }
+
+
+def pupil_video_single_frame_spec(S, acquisition_names, params):
+    return video_frame_spec(S.get_pupil_video(params["acquisition"]), params)
+
+
+def two_photon_video_single_frame_spec(S, acquisition_names, params):
+    return video_frame_spec(S.get_two_photon_series(params["acquisition"]), params)
+
+
+def average_pupil_response_spec(S, acquisition_names, params):
+    pupil_radius_data = []
+    first_timestamps = None
+    for acq_name in acquisition_names:
+        if not S.has_pupil_radius(acq_name):
+            continue
+        pupil_radius = S.get_pupil_radius(acq_name)
+        if first_timestamps is None:
+            first_timestamps = pupil_radius.get_timestamps()
+        pupil_radius_data.append(np.interp(first_timestamps, pupil_radius.get_timestamps() - pupil_radius.starting_time, pupil_radius.get_data()))
+    if first_timestamps is None:
+        raise ValueError("No pupil radius data")
+    mean_pupil_radius = np.nanmean(np.array(pupil_radius_data), axis=0)
+    return {
+        "kind": "lines",
+        "lines": [(first_timestamps - first_timestamps[0], mean_pupil_radius)],
+        "figsize": params["figsize"],
+        "title": params["title"],
+        "xlabel": "Time (sec)",
+        "ylabel": "Pupil Radius (pixels)",
+        "grid": "x",
+    }
+
+
+def pupil_radius_acquisitions_aligned_spec(S, acquisition_names, params):
+    lines = []
+    for acq_name in acquisition_names:
+        if not S.has_pupil_radius(acq_name):
+            continue
+        pupil_radius = S.get_pupil_radius(acq_name)
+        lines.append((pupil_radius.get_timestamps() - pupil_radius.starting_time, pupil_radius.get_data()))
+    return {
+        "kind": "lines",
+        "lines": lines,
+        "figsize": params["figsize"],
+        "title": params["title"],
+        "xlabel": "Time (sec)",
+        "ylabel": "Pupil Radius (pixels)",
+        "grid": "x",
+    }
+
+
+def roi_responses_first_acquisition_spec(S, acquisition_names, params):
+    roi_response_series = S.get_roi_response_series(acquisition_names[0])
+    timestamps = roi_response_series.get_timestamps() - roi_response_series.starting_time
+    roi_data = roi_response_series.get_data()
+    return {
+        "kind": "lines",
+        "lines": [(timestamps, roi_data[:, roi_index]) for roi_index in range(roi_data.shape[1])],
+        "figsize": params["figsize"],
+        "title": params["title"],
+        "xlabel": "Time (sec)",
+        "ylabel": "Fluorescence Intensity",
+    }
+
+
+PLOT_SPEC_FUNCTIONS = {
+    "pupil_video_single_frame": pupil_video_single_frame_spec,
+    "two_photon_video_single_frame": two_photon_video_single_frame_spec,
+    "average_pupil_response": average_pupil_response_spec,
+    "pupil_radius_acquisitions_aligned": pupil_radius_acquisitions_aligned_spec,
+    "roi_responses_first_acquisition": roi_responses_first_acquisition_spec,
+}
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {"sessions": {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def write_index(index_path, sessions, manifest):
+    with open(index_path, 'w') as md_file:
+        md_file.write("# Dandiset 001256\n\n")
+        for session in sessions:
+            m = manifest["sessions"].get(session['session_id'])
+            if m is None:
+                continue
+            md_file.write(f"## {session['session_id']}\n\n")
+            md_file.write("<div style=\"display: flex; justify-content: space-between;\">\n")
+            for plot_name in PLOTS:
+                if "url" in m["plots"].get(plot_name, {}):
+                    md_file.write(f"  <img src=\"{m['plots'][plot_name]['url']}\" alt=\"Image\" width=\"300\" />\n")
+            md_file.write("</div>\n\n")
+
+
+# The pipeline has three overlapping stages: the main thread loads the data
+# for each session and builds plot specs, worker processes render the specs to
+# png, and a thread pool uploads the png data. Each plot is recorded in the
+# manifest only once its upload has finished.
+class Pipeline:
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.renderer = FigureRenderer(max_in_flight=8)
+        self.pending_renders = []
+        self.pending_uploads = []
+
+    def submit_render(self, session_id, session_path, plot_name, input_hash, spec):
+        future = self.renderer.submit(spec)
+        self.pending_renders.append((session_id, session_path, plot_name, input_hash, future))
+
+    def collect(self, wait=False):
+        still_pending = []
+        for session_id, session_path, plot_name, input_hash, future in self.pending_renders:
+            if not wait and not future.done():
+                still_pending.append((session_id, session_path, plot_name, input_hash, future))
                 continue
-                
-        pupil_radius_data = np.array(pupil_radius_data)
-        mean_pupil_radius = np.nanmean(pupil_radius_data, axis=0)
-        plt.figure(figsize=(6, 4))
-        plt.plot(first_timestamps - first_timestamps[0], mean_pupil_radius)
-        plt.title("Average Pupil Response")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Pupil Radius (pixels)")
-        plt.grid(axis='x')
-        cache_buster = generate_cache_buster()
-        average_pupil_url = f"https://lindi.neurosift.org/tmp/{session_path}/average_pupil_response.png?cb={cache_buster}"
-        plot_urls.append(average_pupil_url)
-        upload_figure(plt, average_pupil_url)
-        plt.clf()
-
-        # Plot all pupil radius acquisitions aligned to start time
-        plt.figure(figsize=(6, 4))
-        for acq_name in acquisition_names:
-            try:
-                pupil_radius = S.get_pupil_radius(acq_name)
-                plt.plot(pupil_radius.get_timestamps() - pupil_radius.starting_time, pupil_radius.get_data())
-            except Exception as e:
+            self._on_rendered(session_id, session_path, plot_name, input_hash, future)
+        self.pending_renders = still_pending
+
+        still_pending = []
+        for session_id, plot_name, entry, future in self.pending_uploads:
+            if not wait and not future.done():
+                still_pending.append((session_id, plot_name, entry, future))
+                continue
+            e = future.exception()
+            if e is not None:
+                # Not recorded, so the upload is retried on the next run
+                print(f"Error uploading {plot_name} for session {session_id}: {e}")
+                continue
+            self.manifest["sessions"][session_id]["plots"][plot_name] = entry
+        self.pending_uploads = still_pending
+
+    def close(self):
+        self.collect(wait=True)
+        self.renderer.close()
+        try:
+            flush_uploads()
+        except Exception:
+            pass  # already reported in collect()
+
+    def _on_rendered(self, session_id, session_path, plot_name, input_hash, future):
+        m = self.manifest["sessions"][session_id]
+        e = future.exception()
+        if e is not None:
+            # Not recorded, so the plot is retried on the next run (the error
+            # may be transient, e.g. a network timeout)
+            print(f"Error rendering plot {plot_name} for session {session_id}: {e}")
+            return
+        png_data = future.result()
+        output_hash = compute_hash(png_data)
+        previous = m["plots"].get(plot_name)
+        if previous is not None and previous.get("output_hash") == output_hash:
+            print(f"  {session_id} {plot_name}: unchanged, not uploading")
+            m["plots"][plot_name] = {
+                "input_hash": input_hash,
+                "output_hash": output_hash,
+                "url": previous["url"],
+            }
+            return
+        url = f"https://lindi.neurosift.org/tmp/{session_path}/{plot_name}.png?cb={output_hash[:8]}"
+        print(f"  {session_id} {plot_name}: uploading")
+        entry = {
+            "input_hash": input_hash,
+            "output_hash": output_hash,
+            "url": url,
+        }
+        # The previous entry (if any) stays in the manifest until the upload has finished
+        upload_future = upload_file_data_async(url, png_data)
+        self.pending_uploads.append((session_id, plot_name, entry, upload_future))
+
+
+def main():
+    # Prepare directories
+    output_dir = "./genie_output"
+    index_path = os.path.join(output_dir, "index.md")
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    manifest = load_manifest(manifest_path)
+
+    # Fetch information about the Dandiset and its sessions
+    info = get_dandiset_info()
+    sessions = info['sessions']
+
+    pipeline = Pipeline(manifest)
+    try:
+        # Iterate through each session
+        for session in sessions:
+            session_id = session['session_id']
+            asset_id = session['asset_id']
+            session_path = f"dandi/dandiset-001256/genie/sessions/{session_id}"
+
+            m = manifest["sessions"].get(session_id)
+            if m is None or m["asset_id"] != asset_id:
+                m = {"asset_id": asset_id, "plots": {}}
+                manifest["sessions"][session_id] = m
+            input_hashes = {plot_name: compute_input_hash(asset_id, plot_name) for plot_name in PLOTS}
+            # (manifests written by earlier versions may hold failed entries
+            # without a url, which are retried too)
+            stale_plot_names = [
+                plot_name for plot_name in PLOTS
+                if "url" not in m["plots"].get(plot_name, {}) or m["plots"][plot_name]["input_hash"] != input_hashes[plot_name]
+            ]
+            if not stale_plot_names:
+                print(f"Session {session_id} is up to date")
                 continue
-        plt.title("Pupil Radius Aligned to Start Time")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Pupil Radius (pixels)")
-        plt.grid(axis='x')
-        cache_buster = generate_cache_buster()
-        pupil_radius_aligned_url = f"https://lindi.neurosift.org/tmp/{session_path}/pupil_radius_acquisitions_aligned.png?cb={cache_buster}"
-        plot_urls.append(pupil_radius_aligned_url)
-        upload_figure(plt, pupil_radius_aligned_url)
-        plt.clf()
-
-        # Plot the ROI responses for the first acquisition
-        roi_response_series = S.get_roi_response_series(acquisition_names[0])
-        timestamps = roi_response_series.get_timestamps() - roi_response_series.starting_time
-        roi_data = roi_response_series.get_data()
-        plt.figure(figsize=(6, 4))
-        for roi_index in range(roi_data.shape[1]):
-            plt.plot(timestamps, roi_data[:, roi_index])
-        plt.title("ROI Responses First Acquisition")
-        plt.xlabel("Time (sec)")
-        plt.ylabel("Fluorescence Intensity")
-        cache_buster = generate_cache_buster()
-        roi_response_url = f"https://lindi.neurosift.org/tmp/{session_path}/roi_responses_first_acquisition.png?cb={cache_buster}"
-        plot_urls.append(roi_response_url)
-        upload_figure(plt, roi_response_url)
-        plt.clf()
-        
-    except Exception as e:
-        print(f"Error processing session {session_id}: {e}")
-
-    # Write the URLs to the markdown file
-    with open(index_path, 'a') as md_file:
-        md_file.write("<div style=\"display: flex; justify-content: space-between;\">\n")
-        for url in plot_urls:
-            md_file.write(f"  <img src=\"{url}\" alt=\"Image\" width=\"300\" />\n")
-        md_file.write("</div>\n\n")
-
-print("Processing complete.")
\ No newline at end of file
+
+            print(f"Processing session: {session_id} ({len(stale_plot_names)} plots to update)")
+            S = load_session(nwb_url=session['asset_url'])
+            acquisition_names = S.get_acquisition_names()
+
+            for plot_name in stale_plot_names:
+                try:
+                    spec = PLOT_SPEC_FUNCTIONS[plot_name](S, acquisition_names, PLOTS[plot_name])
+                except Exception as e:
+                    # Not recorded, so the plot is retried on the next run
+                    print(f"Error creating plot {plot_name} for session {session_id}: {e}")
+                    continue
+                pipeline.submit_render(session_id, session_path, plot_name, input_hashes[plot_name], spec)
+
+            pipeline.collect()
+            write_manifest(manifest_path, manifest)
+            write_index(index_path, sessions, manifest)
+
+        print("Waiting for rendering and uploads to finish")
+    finally:
+        pipeline.close()
+        write_manifest(manifest_path, manifest)
+        write_index(index_path, sessions, manifest)
+
+    print("Processing complete.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from typing import Union
+
+
+# A plot spec is a dict holding the data (numpy arrays) and the plotting
+# parameters for a single figure, for example
+#
+#   {"kind": "image", "image": frame, "figsize": [6, 6], "title": "...", "cmap": "gray"}
+#   {"kind": "lines", "lines": [(x, y), ...], "figsize": [6, 4], "title": "...",
+#    "xlabel": "...", "ylabel": "...", "grid": "x"}
+#
+# Specs are rendered to png bytes in worker processes using the Agg backend.
+# The workers do not use pyplot, so there is no global figure registry. Each
+# worker keeps one figure per figsize, which is cleared and reused for the next
+# spec, so the number of live figures is bounded by the number of workers.
+class FigureRenderer:
+    def __init__(self, *, max_workers: Union[int, None] = None, max_in_flight: int = 8):
+        # spawn rather than fork, since the parent may have network threads running
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def submit(self, spec: dict) -> Future:
+        # blocks if max_in_flight specs are already being rendered
+        self._in_flight.acquire()
+        try:
+            future = self._executor.submit(render_plot_spec, spec)
+        except BaseException:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda f: self._in_flight.release())
+        return future
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_worker_figures = {}
+
+
+def _init_worker():
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def render_plot_spec(spec: dict) -> bytes:
+    fig = _get_figure(spec["figsize"])
+    try:
+        ax = fig.add_subplot(1, 1, 1)
+        if spec["kind"] == "image":
+            ax.imshow(spec["image"], cmap=spec.get("cmap", "gray"))
+            ax.axis('off')
+        elif spec["kind"] == "lines":
+            for x, y in spec["lines"]:
+                ax.plot(x, y)
+            ax.set_xlabel(spec.get("xlabel", ""))
+            ax.set_ylabel(spec.get("ylabel", ""))
+            if spec.get("grid") is not None:
+                ax.grid(axis=spec["grid"])
+        else:
+            raise ValueError(f"Unexpected plot spec kind: {spec['kind']}")
+        ax.set_title(spec.get("title", ""))
+        buf = BytesIO()
+        fig.savefig(buf, format="png", bbox_inches='tight', pad_inches=0)
+        return buf.getvalue()
+    finally:
+        fig.clear()
+
+
+def _get_figure(figsize):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    key = tuple(figsize)
+    if key not in _worker_figures:
+        fig = Figure(figsize=key)
+        FigureCanvasAgg(fig)
+        _worker_figures[key] = fig
+    return _worker_figures[key]
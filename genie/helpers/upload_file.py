@@ -1,71 +1,183 @@
-import tempfile
-import time
 import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Union
 
 
-def upload_file_data(url: str, data: bytes):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        filename = f"{tmpdir}/file"
-        with open(filename, "wb") as f:
-            f.write(data)
-        upload_file(url, filename)
+# Uploads in-memory data to the neurosift-lindi bucket using a single S3 client
+# and a bounded pool of worker threads. submit() returns right away (unless
+# max_in_flight uploads are already pending), so the caller can keep working
+# while uploads are in flight. flush() waits for all pending uploads and raises
+# if any of them failed. To test against a local S3-compatible server, pass a
+# client created with the appropriate endpoint_url.
+class Uploader:
+    def __init__(
+        self,
+        *,
+        client=None,
+        bucket: str = "neurosift-lindi",
+        max_workers: int = 8,
+        max_in_flight: int = 32,
+        num_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20
+    ):
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.bucket = bucket
+        self.num_retries = num_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._pending = set()
+        self._errors = []
+        self._lock = threading.Lock()
 
+    def submit(self, url: str, data: bytes, *, report_error_on_flush: bool = True) -> Future:
+        object_key = _get_object_key(url)
+        print(f"Uploading {len(data)} bytes to {url}")
+        self._in_flight.acquire()
+        try:
+            future = self._executor.submit(self._upload, object_key, data)
+        except BaseException:
+            self._in_flight.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(lambda f: self._on_done(f, report_error_on_flush))
+        return future
 
-def upload_file(url: str, filename: str):
-    import boto3
+    def flush(self):
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            for f in pending:
+                f.exception()  # wait, without raising
+        with self._lock:
+            errors = self._errors
+            self._errors = []
+        if errors:
+            raise Exception(f"{len(errors)} upload(s) failed. First error: {errors[0]}") from errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _on_done(self, future: Future, report_error_on_flush: bool):
+        self._in_flight.release()
+        with self._lock:
+            self._pending.discard(future)
+            e = future.exception()
+            if e is not None and report_error_on_flush:
+                self._errors.append(e)
+
+    def _get_client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = _create_s3_client()
+            return self._client
+
+    def _upload(self, object_key: str, data: bytes):
+        s3 = self._get_client()
+        extra_args = {}
+        content_type = _get_content_type(object_key)
+        if content_type is not None:
+            extra_args["ContentType"] = content_type
+        attempt = 0
+        while True:
+            try:
+                s3.put_object(Bucket=self.bucket, Key=object_key, Body=data, **extra_args)
+                return
+            except Exception as e:
+                if attempt >= self.num_retries:
+                    raise
+                # exponential backoff with full jitter
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                print(f"Error uploading {object_key} to S3 (retrying in {delay:.1f} sec): {e}")
+                time.sleep(delay)
+                attempt += 1
+
+
+_default_uploader: Union[Uploader, None] = None
+_default_uploader_lock = threading.Lock()
+
+
+def get_default_uploader():
+    global _default_uploader
+    with _default_uploader_lock:
+        if _default_uploader is None:
+            _default_uploader = Uploader()
+        return _default_uploader
 
-    if '?' in url:
-        print("Warning: URL for uploading file contains a query string. Ignoring.")
-        url = url.split('?')[0]
 
+def upload_file_data_async(url: str, data: bytes) -> Future:
+    return get_default_uploader().submit(url, data)
+
+
+def flush_uploads():
+    get_default_uploader().flush()
+
+
+def upload_file_data(url: str, data: bytes):
+    get_default_uploader().submit(url, data, report_error_on_flush=False).result()
+
+
+def upload_file(url: str, filename: str):
     filename = str(filename)  # in case it comes in as a Path object
+    with open(filename, "rb") as f:
+        data = f.read()
+    upload_file_data(url, data)
 
-    print(f"Uploading {filename} to {url}")
 
-    if not url.startswith("https://lindi.neurosift.org/tmp/"):
-        raise ValueError(f"Invalid URL for uploading text file: {url}")
-    s3 = boto3.client(
+def _create_s3_client():
+    import boto3
+
+    return boto3.client(
         "s3",
         aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
         aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
         endpoint_url=os.environ["S3_ENDPOINT_URL"],
         region_name="auto",  # for cloudflare
     )
-    bucket = "neurosift-lindi"
-    object_key = url[len("https://lindi.neurosift.org/"):]
-    _upload_file_to_s3(s3, bucket, object_key, filename)
-
-
-def _upload_file_to_s3(s3, bucket, object_key, fname):
-    if fname.endswith(".html"):
-        content_type = "text/html"
-    elif fname.endswith(".js"):
-        content_type = "application/javascript"
-    elif fname.endswith(".css"):
-        content_type = "text/css"
-    elif fname.endswith(".png"):
-        content_type = "image/png"
-    elif fname.endswith(".jpg"):
-        content_type = "image/jpeg"
-    elif fname.endswith(".svg"):
-        content_type = "image/svg+xml"
-    elif fname.endswith(".json"):
-        content_type = "application/json"
-    elif fname.endswith(".gz"):
-        content_type = "application/gzip"
+
+
+def _get_object_key(url: str):
+    if '?' in url:
+        url = url.split('?')[0]  # the query string is only for cache busting
+    if not url.startswith("https://lindi.neurosift.org/tmp/"):
+        raise ValueError(f"Invalid URL for uploading file: {url}")
+    return url[len("https://lindi.neurosift.org/"):]
+
+
+def _get_content_type(object_key: str):
+    if object_key.endswith(".html"):
+        return "text/html"
+    elif object_key.endswith(".js"):
+        return "application/javascript"
+    elif object_key.endswith(".css"):
+        return "text/css"
+    elif object_key.endswith(".png"):
+        return "image/png"
+    elif object_key.endswith(".jpg"):
+        return "image/jpeg"
+    elif object_key.endswith(".svg"):
+        return "image/svg+xml"
+    elif object_key.endswith(".json"):
+        return "application/json"
+    elif object_key.endswith(".gz"):
+        return "application/gzip"
     else:
-        content_type = None
-    extra_args = {}
-    if content_type is not None:
-        extra_args["ContentType"] = content_type
-    num_retries = 3
-    while True:
-        try:
-            s3.upload_file(fname, bucket, object_key, ExtraArgs=extra_args)
-            break
-        except Exception as e:
-            print(f"Error uploading {object_key} to S3: {e}")
-            time.sleep(3)
-            num_retries -= 1
-            if num_retries == 0:
-                raise
+        return None
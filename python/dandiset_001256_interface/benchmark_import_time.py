@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Measures the time to import the package in a fresh interpreter, and checks
+# that it stays within a budget and does not pull in the heavy dependencies.
+# Exits with a non-zero status if the check fails, so it can be run in CI:
+#
+#   python benchmark_import_time.py --budget 0.3
+
+heavy_modules = ["numpy", "pynwb", "lindi", "requests", "h5py", "hdmf"]
+
+_measure_script = """
+import json, sys, time
+t0 = time.perf_counter()
+import dandiset_001256_interface
+t1 = time.perf_counter()
+{access}
+t2 = time.perf_counter()
+print(json.dumps({{"import": t1 - t0, "access": t2 - t1, "loaded": [m for m in {heavy_modules!r} if m in sys.modules]}}))
+"""
+
+
+def measure(*, access: str = ""):
+    script = _measure_script.format(access=access, heavy_modules=heavy_modules)
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH", "")])}
+    out = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True, env=env).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of dandiset_001256_interface")
+    parser.add_argument("--budget", type=float, default=0.3, help="Maximum allowed import time in seconds (best of the runs)")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.runs)]
+    import_time = min(r["import"] for r in results)
+    loaded = sorted(set(m for r in results for m in r["loaded"]))
+    print(f"import dandiset_001256_interface: {import_time * 1000:.1f} ms (best of {args.runs})")
+    r = measure(access="dandiset_001256_interface.load_session")
+    print(f"first access of load_session: {r['access'] * 1000:.1f} ms")
+    r = measure(access="import pynwb, lindi")
+    print(f"deferred until a session is opened (pynwb, lindi): {r['access'] * 1000:.1f} ms")
+
+    ok = True
+    if loaded:
+        print(f"FAIL: importing the package loaded {', '.join(loaded)}")
+        ok = False
+    if import_time > args.budget:
+        print(f"FAIL: import time exceeds the budget of {args.budget * 1000:.0f} ms")
+        ok = False
+    if ok:
+        print("OK")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
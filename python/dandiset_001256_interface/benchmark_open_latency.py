@@ -0,0 +1,57 @@
+import argparse
+import time
+import tracemalloc
+
+
+# Compares the time (and Python memory) it takes to open a session and get to
+# the first ROI responses with each Session backend:
+#
+#   python benchmark_open_latency.py --runs 3
+#   python benchmark_open_latency.py --nwb-url https://api.dandiarchive.org/api/assets/<asset_id>/download/
+
+
+def measure(nwb_url: str, backend: str):
+    from dandiset_001256_interface.Session import Session
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    S = Session(nwb_url=nwb_url, backend=backend)
+    t1 = time.perf_counter()
+    acquisition_names = S.get_acquisition_names()
+    if acquisition_names:
+        S.get_roi_response_series(acquisition_names[0]).get_data(0, 10)
+    t2 = time.perf_counter()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"open": t1 - t0, "first_read": t2 - t1, "peak_bytes": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the open latency of the Session backends")
+    parser.add_argument("--nwb-url", default=None, help="Session to open (default: the first session of the dandiset)")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    nwb_url = args.nwb_url
+    if nwb_url is None:
+        from dandiset_001256_interface import get_dandiset_info
+
+        nwb_url = get_dandiset_info()["sessions"][0]["asset_url"]
+    # import once up front, so that the first run does not include the imports
+    import lindi  # noqa
+    import pynwb  # noqa
+
+    results = {"pynwb": [], "raw": []}
+    for _ in range(args.runs):
+        for backend in results:
+            results[backend].append(measure(nwb_url, backend))
+    print(f"{nwb_url} (best of {args.runs})")
+    for backend, rr in results.items():
+        open_time = min(r["open"] for r in rr)
+        first_read = min(r["first_read"] for r in rr)
+        peak_mb = min(r["peak_bytes"] for r in rr) / 1e6
+        print(f"{backend:>6}: open {open_time * 1000:8.1f} ms, first read {first_read * 1000:8.1f} ms, peak Python memory {peak_mb:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Runs range reads through RemoteReader against a local HTTP server that
+# injects slow responses and failures, and reports latency stats with and
+# without hedging. Exits with a non-zero status if any read returns wrong
+# bytes or fails.
+#
+#   python benchmark_remote_reads.py --num-reads 400 --slow-fraction 0.03 --fail-fraction 0.05
+
+
+def start_server(*, data: bytes, slow_fraction: float, slow_seconds: float, fail_fraction: float, base_delay: float):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            r = random.random()
+            if r < fail_fraction:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            time.sleep(slow_seconds if r < fail_fraction + slow_fraction else base_delay)
+            start, end = self.headers["Range"][len("bytes="):].split("-")
+            body = data[int(start):int(end) + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(reader, url: str, data: bytes, *, num_reads: int, read_size: int, concurrency: int):
+    rng = random.Random(0)
+    ranges = [(s, s + read_size) for s in (rng.randrange(0, len(data) - read_size) for _ in range(num_reads))]
+    num_errors = 0
+
+    def read(r):
+        nonlocal num_errors
+        try:
+            ok = reader.get_range(url, r[0], r[1]) == data[r[0]:r[1]]
+        except Exception:
+            ok = False
+        if not ok:
+            num_errors += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(read, ranges))
+    return time.perf_counter() - t0, num_errors
+
+
+def main():
+    from dandiset_001256_interface.remote_reader import RemoteReader
+
+    parser = argparse.ArgumentParser(description="Benchmark RemoteReader against a local server that injects delays and failures")
+    parser.add_argument("--num-reads", type=int, default=400)
+    parser.add_argument("--read-size", type=int, default=64 * 1024)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--base-delay", type=float, default=0.01)
+    parser.add_argument("--slow-fraction", type=float, default=0.03)
+    parser.add_argument("--slow-seconds", type=float, default=2)
+    parser.add_argument("--fail-fraction", type=float, default=0.05)
+    args = parser.parse_args()
+
+    data = random.Random(1).randbytes(16 * 1024 * 1024)
+    server = start_server(data=data, slow_fraction=args.slow_fraction, slow_seconds=args.slow_seconds, fail_fraction=args.fail_fraction, base_delay=args.base_delay)
+    url = f"http://127.0.0.1:{server.server_address[1]}/data.bin"
+    ok = True
+    for label, hedge_percentile in [("no hedging", None), ("hedging at p95", 95)]:
+        reader = RemoteReader(hedge_percentile=hedge_percentile, backoff_base=0.01, read_timeout=args.slow_seconds * 5)
+        elapsed, num_errors = run(reader, url, data, num_reads=args.num_reads, read_size=args.read_size, concurrency=args.concurrency)
+        s = reader.get_stats()
+        reader.close()
+        print(f"{label}: {elapsed:.2f} s total, p50 {s['latency_p50'] * 1000:.0f} ms, p99 {s['latency_p99'] * 1000:.0f} ms, max {s['latency_max'] * 1000:.0f} ms, "
+              f"{s['retries']} retries, {s['hedges']} hedges ({s['hedge_wins']} won), {num_errors} errors")
+        ok = ok and num_errors == 0
+    server.shutdown()
+    print("OK" if ok else "FAIL")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,84 @@
-from typing import List
-import requests
+from typing import TYPE_CHECKING, List, Tuple, Union
+import hashlib
+import json
+import math
+import os
 import numpy as np
-from pynwb import NWBHDF5IO
-import lindi
+from .read_planner import ReadPlanner
+from .accumulators import RunningCovariance
+from .cache_dir import get_cache_dir
+from .dff import compute_dff
+from .resample import get_source_row_range, resample_methods, resample_uniform
+from .get_dandiset_info import dandiset_version
+from .shared_arrays import publish_session_arrays
+from .remote_reader import get_default_remote_reader
+from .local_frame_store import LocalFrameStore, create_local_frame_store
+from .preloaded_arrays import preload_session_arrays
+
+if TYPE_CHECKING:
+    import lindi
+
+
+session_backends = ["pynwb", "raw"]
 
 
 class Session:
-    def __init__(self, *, nwb_url: str):
+    def __init__(self, *, nwb_url: str, local_cache: Union["lindi.LocalCache", None] = None, backend: str = "pynwb", cache_lindi_file: bool = True):
+        # backend is "pynwb" (read the full NWB object graph, available as
+        # self.nwb) or "raw" (serve the series directly from the group paths
+        # and attributes of the file, which is much faster to open)
+        #
+        # For a DANDI asset, the precomputed lindi file is downloaded once into
+        # the local cache (unless cache_lindi_file is False), and later opens
+        # use the local copy. When there is no precomputed lindi file, the HDF5
+        # metadata is crawled once and saved there instead.
+        if backend not in session_backends:
+            raise ValueError(f"Unexpected backend: {backend}")
+        # pynwb and lindi take a while to import, so they are imported here
+        # rather than when the package is imported
+        import lindi
+
         self.nwb_url = nwb_url
+        self.backend = backend
 
-        lindi_url = _try_get_lindi_url(nwb_url, "001256")
+        local_lindi_file_path = _get_local_lindi_file_path(nwb_url, "001256") if cache_lindi_file else None
+        if local_lindi_file_path is not None and os.path.exists(local_lindi_file_path):
+            lindi_url = local_lindi_file_path
+        else:
+            lindi_url = _try_get_lindi_url(nwb_url, "001256")
+            if lindi_url is not None and lindi_url != nwb_url and local_lindi_file_path is not None:
+                lindi_url = _download_lindi_file(lindi_url, local_lindi_file_path) or lindi_url
+        if lindi_url is None and local_lindi_file_path is not None:
+            print("Loading from HDF5 and generating a local lindi file")
+            lindi_url = _generate_local_lindi_file(nwb_url, local_lindi_file_path, local_cache=local_cache)
         if lindi_url is not None:
             print("Loading from lindi")
-            f = lindi.LindiH5pyFile.from_lindi_file(lindi_url)
+            f = lindi.LindiH5pyFile.from_lindi_file(lindi_url, local_cache=local_cache)
         else:
             print("Loading from HDF5")
-            f = lindi.LindiH5pyFile.from_hdf5_file(nwb_url)
-        self.nwb = NWBHDF5IO(file=f, mode="r").read()
+            f = lindi.LindiH5pyFile.from_hdf5_file(nwb_url, local_cache=local_cache)
+        self._file = f
+        self._local_cache = local_cache
+        # The read planner needs the chunk references, which are only cheap to
+        # get when loading from a lindi file
+        self._use_read_planner = lindi_url is not None
+        self._read_planner = None
+        self._availability = None
+        self._roi_bboxes = {}
+        # (kind, acquisition_name) -> array held in memory by preload()
+        self._preloaded_arrays = {}
+        if backend == "pynwb":
+            from pynwb import NWBHDF5IO
+
+            self.nwb = NWBHDF5IO(file=f, mode="r").read()
+            acquisition_keys = list(self.nwb.acquisition.keys())  # type: ignore
+        else:
+            self.nwb = None
+            acquisition_keys = list(f["acquisition"].keys()) if "acquisition" in f else []
 
         self._acquisition_names: List[str] = []
         # Get the acquisition names from TwoPhotonSeries_000, TwoPhotonSeries_001, etc.
-        for k in self.nwb.acquisition.keys():  # type: ignore
+        for k in acquisition_keys:
             if k.startswith("TwoPhotonSeries_"):
                 p = k.split("_")
                 if len(p) == 2:
@@ -30,81 +88,683 @@ class Session:
         return [a for a in self._acquisition_names]
 
     def get_two_photon_series(self, acquisition_name: str):
-        return ImageSeries(self.nwb.acquisition[f"TwoPhotonSeries_{acquisition_name}"])  # type: ignore
+        if self.nwb is None:
+            return ImageSeries(self._get_raw_series("two_photon", acquisition_name), planner=self._get_read_planner(), cache_key=self._get_series_cache_key("two_photon", acquisition_name))
+        return ImageSeries(self.nwb.acquisition[f"TwoPhotonSeries_{acquisition_name}"], planner=self._get_read_planner(), cache_key=self._get_series_cache_key("two_photon", acquisition_name))  # type: ignore
+
+    def get_motion_corrected_two_photon_series(self, acquisition_name: str):
+        if self.nwb is None:
+            return ImageSeries(self._get_raw_series("motion_corrected_two_photon", acquisition_name), planner=self._get_read_planner(), cache_key=self._get_series_cache_key("motion_corrected_two_photon", acquisition_name))
+        return ImageSeries(self.nwb.processing["ophys"]["Motion Corrected TwoPhotonSeries"].corrected_image_stacks[f"motion_corrected_TwoPhotonSeries_{acquisition_name}"].corrected, planner=self._get_read_planner(), cache_key=self._get_series_cache_key("motion_corrected_two_photon", acquisition_name))  # type: ignore
 
     def get_pupil_video(self, acquisition_name: str):
-        return ImageSeries(self.nwb.processing["behavior"][f"pupil_video_{acquisition_name}"])  # type: ignore
+        if self.nwb is None:
+            return ImageSeries(self._get_raw_series("pupil_video", acquisition_name), planner=self._get_read_planner(), cache_key=self._get_series_cache_key("pupil_video", acquisition_name))
+        return ImageSeries(self.nwb.processing["behavior"][f"pupil_video_{acquisition_name}"], planner=self._get_read_planner(), cache_key=self._get_series_cache_key("pupil_video", acquisition_name))  # type: ignore
 
     def get_pupil_radius(self, acquisition_name: str):
-        return TimeSeries(self.nwb.processing["behavior"]["PupilTracking"][f"pupil_radius_{acquisition_name}"])  # type: ignore
+        if self.nwb is None:
+            return TimeSeries(self._get_raw_series("pupil_radius", acquisition_name), planner=self._get_read_planner(), preloaded=self._preloaded_arrays.get(("pupil_radius", acquisition_name)))
+        return TimeSeries(self.nwb.processing["behavior"]["PupilTracking"][f"pupil_radius_{acquisition_name}"], planner=self._get_read_planner(), preloaded=self._preloaded_arrays.get(("pupil_radius", acquisition_name)))  # type: ignore
+
+    def _get_raw_series(self, kind: str, acquisition_name: str):
+        parent_path, prefix, subgroup_name = _series_locations[kind]
+        path = f"{parent_path}/{prefix}{acquisition_name}"
+        if subgroup_name is not None:
+            path += f"/{subgroup_name}"
+        g = _get_group_or_none(self._file, path)
+        if g is None:
+            raise KeyError(f"Series not found: {path}")
+        return _RawSeries(g)
+
+    def get_availability(self):
+        # For each acquisition, the series that exist along with their shapes,
+        # rates and starting times (None if the series is missing). This only
+        # looks at the group listings and metadata, never at the series data.
+        if self._availability is None:
+            self._availability = _get_availability(self._file, self._acquisition_names)
+        return self._availability
+
+    def has_availability(self):
+        # Whether get_availability() is already in memory
+        return self._availability is not None
+
+    def save_availability(self, fname: str):
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.get_availability(), f)
+        os.replace(tmp_fname, fname)
+
+    def load_availability(self, fname: str):
+        # Uses the availability saved by save_availability, if it covers the
+        # acquisitions of this session. Returns whether it was used.
+        with open(fname) as f:
+            availability = json.load(f)
+        if sorted(availability) != sorted(self._acquisition_names):
+            return False
+        self._availability = availability
+        return True
+
+    def has_two_photon_series(self, acquisition_name: str):
+        return self.has_series(acquisition_name, "two_photon")
+
+    def has_motion_corrected_two_photon_series(self, acquisition_name: str):
+        return self.has_series(acquisition_name, "motion_corrected_two_photon")
+
+    def has_pupil_video(self, acquisition_name: str):
+        return self.has_series(acquisition_name, "pupil_video")
+
+    def has_pupil_radius(self, acquisition_name: str):
+        return self.has_series(acquisition_name, "pupil_radius")
+
+    def has_roi_response_series(self, acquisition_name: str):
+        return self.has_series(acquisition_name, "roi_responses")
+
+    def has_series(self, acquisition_name: str, kind: str):
+        # kind is one of the keys of the get_availability() entries
+        a = self.get_availability().get(acquisition_name)
+        return a is not None and a[kind] is not None
 
     def get_num_rois(self):
         first_acquisition_name = self._acquisition_names[0]
         r = self.get_roi_response_series(first_acquisition_name)
         return r.num_channels
 
+    def get_roi_bbox(self, roi: int, *, pad: int = 0):
+        # The bounding box (row_start, row_end, col_start, col_end) of the ROI
+        # mask (roi is the 1-based ROI number), grown by pad pixels on each
+        # side and clipped to the imaging plane
+        if roi not in self._roi_bboxes:
+            self._roi_bboxes[roi] = self._compute_roi_bbox(roi)
+        r1, r2, c1, c2, height, width = self._roi_bboxes[roi]
+        return max(0, r1 - pad), min(height, r2 + pad), max(0, c1 - pad), min(width, c2 + pad)
+
+    def _compute_roi_bbox(self, roi: int):
+        ps = self._get_plane_segmentation_group()
+        planner = self._get_read_planner()
+        if "image_mask" in ps:
+            image_mask = ps["image_mask"]
+            num_rois, height, width = image_mask.shape
+            if roi < 1 or roi > num_rois:
+                raise ValueError(f"Invalid ROI number {roi} (there are {num_rois} ROIs)")
+            mask = _read_selection(image_mask, (roi - 1,), planner=planner)
+            rows = np.flatnonzero(np.any(mask != 0, axis=1))
+            cols = np.flatnonzero(np.any(mask != 0, axis=0))
+        elif "pixel_mask" in ps:
+            # pixel_mask holds (x, y, weight) entries, with x and y the first
+            # and second image dimensions; pixel_mask_index holds the end
+            # index of each ROI's entries. There is no image size here, so
+            # use the frame shape of the two-photon series.
+            index = ps["pixel_mask_index"][()]
+            if roi < 1 or roi > len(index):
+                raise ValueError(f"Invalid ROI number {roi} (there are {len(index)} ROIs)")
+            i1 = int(index[roi - 2]) if roi > 1 else 0
+            pixels = ps["pixel_mask"][i1:int(index[roi - 1])]
+            rows = np.unique(pixels["x"].astype(np.int64))
+            cols = np.unique(pixels["y"].astype(np.int64))
+            height, width = self.get_two_photon_series(self._acquisition_names[0]).frame_shape
+        else:
+            raise KeyError(f"No image_mask or pixel_mask in {ps.name}")
+        if len(rows) == 0:
+            raise ValueError(f"Empty mask for ROI {roi}")
+        return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1, int(height), int(width)
+
+    def _get_plane_segmentation_group(self):
+        g = _get_group_or_none(self._file, "/processing/ophys/ImageSegmentation")
+        names = sorted(k for k in g.keys() if k.startswith("PlaneSegmentation")) if g is not None else []
+        if not names:
+            raise KeyError("No PlaneSegmentation found in /processing/ophys/ImageSegmentation")
+        return g[names[0]]
+
+    def get_roi_movie(self, acquisition_name: str, roi: int, *, pad: int = 5, start: Union[int, None] = None, end: Union[int, None] = None, motion_corrected: bool = False):
+        # Frames [start, end) of the two-photon series (or the motion
+        # corrected series), cropped to the padded bounding box of the ROI.
+        # Only the chunks that intersect the box are read.
+        X = self.get_motion_corrected_two_photon_series(acquisition_name) if motion_corrected else self.get_two_photon_series(acquisition_name)
+        return X.get_crop((start, end), self.get_roi_bbox(roi, pad=pad))
+
     def get_roi_response_series(self, acquisition_name: str):
-        return MultichannelTimeSeries(self.nwb.processing["ophys"]["Fluorescence"][f"RoiResponseSeries_{acquisition_name}"])  # type: ignore
+        if self.nwb is None:
+            return MultichannelTimeSeries(self._get_raw_series("roi_responses", acquisition_name), planner=self._get_read_planner(), cache_key=self._get_series_cache_key("roi_responses", acquisition_name), preloaded=self._preloaded_arrays.get(("roi_responses", acquisition_name)))
+        return MultichannelTimeSeries(self.nwb.processing["ophys"]["Fluorescence"][f"RoiResponseSeries_{acquisition_name}"], planner=self._get_read_planner(), cache_key=self._get_series_cache_key("roi_responses", acquisition_name), preloaded=self._preloaded_arrays.get(("roi_responses", acquisition_name)))  # type: ignore
+
+    def roi_correlation(self, acquisition_names: Union[List[str], None] = None, *, window=None, lag: int = 0, use_cache: bool = True):
+        # The (num_rois, num_rois) correlation between ROI i at sample t and
+        # ROI j at sample t + lag, pooled over the acquisitions and windows.
+        # window is a (t_start, t_end) pair in seconds relative to the start
+        # of each acquisition, or a list of such pairs (default: everything).
+        return self._get_roi_comoments(acquisition_names, window=window, lag=lag, use_cache=use_cache).get_correlation()
+
+    def roi_covariance(self, acquisition_names: Union[List[str], None] = None, *, window=None, lag: int = 0, use_cache: bool = True, ddof: int = 1):
+        return self._get_roi_comoments(acquisition_names, window=window, lag=lag, use_cache=use_cache).get_covariance(ddof=ddof)
+
+    def _get_roi_comoments(self, acquisition_names: Union[List[str], None], *, window, lag: int, use_cache: bool):
+        if acquisition_names is None:
+            acquisition_names = [a for a in self.get_acquisition_names() if self.has_roi_response_series(a)]
+        windows = _normalize_windows(window)
+        cache_fname = None
+        if use_cache:
+            key = json.dumps([self.get_cache_key(), list(acquisition_names), windows, int(lag)])
+            cache_fname = os.path.join(get_cache_dir("roi_comoments"), hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+            if os.path.exists(cache_fname):
+                with np.load(cache_fname) as d:
+                    return RunningCovariance.from_dict(d)
+        acc = RunningCovariance(self.get_num_rois())
+        for a in acquisition_names:
+            X = self.get_roi_response_series(a)
+            for w in windows:
+                i1, i2 = _window_to_sample_range(w, X.rate, X.num_samples)
+                _accumulate_lagged_comoments(acc, X, i1, i2, lag)
+        if cache_fname is not None:
+            tmp_fname = cache_fname + ".tmp.npz"
+            np.savez(tmp_fname, **acc.to_dict())
+            os.replace(tmp_fname, cache_fname)
+        return acc
+
+    def get_joint_timeseries(
+        self,
+        acquisition_name: str,
+        *,
+        rate: float,
+        kinds: List[str] = ["pupil_radius", "roi_responses"],
+        method: str = "linear",
+        dtype=np.float64
+    ):
+        # Resamples the requested series of an acquisition onto one clock at
+        # the given rate, covering the time range where all of them have data.
+        # kinds are "pupil_radius", "roi_responses" and "roi_dff" (dF/F with
+        # the default get_dff parameters). method is "linear", "nearest" or
+        # "decimate" (low-pass filtered to the new Nyquist frequency before
+        # linear interpolation, for series sampled faster than rate).
+        # Returns (data, labels, timestamps), where data is a contiguous array
+        # of shape (num_samples, num_features) and labels are the column names
+        # ("pupil_radius", "roi_001", "roi_dff_001", ...). If the series have
+        # no common time range, num_samples is 0.
+        if method not in resample_methods:
+            raise ValueError(f"Unexpected resampling method: {method}")
+        series = []
+        for kind in kinds:
+            if kind == "pupil_radius":
+                series.append((kind, self.get_pupil_radius(acquisition_name)))
+            elif kind in ["roi_responses", "roi_dff"]:
+                series.append((kind, self.get_roi_response_series(acquisition_name)))
+            else:
+                raise ValueError(f"Unexpected kind: {kind}")
+        t1 = max(X.starting_time for _, X in series)
+        t2 = min(X.starting_time + (X.num_samples - 1) / X.rate for _, X in series)
+        num_samples = max(0, int(np.floor((t2 - t1) * rate + 1e-9)) + 1)
+        timestamps = t1 + np.arange(num_samples) / rate
+        num_features = sum(1 if kind == "pupil_radius" else X.num_channels for kind, X in series)
+        data = np.empty((num_samples, num_features), dtype=dtype)
+        labels = []
+        j = 0
+        for kind, X in series:
+            width = 1 if kind == "pupil_radius" else X.num_channels
+            # when the series do not overlap in time, data has no rows and
+            # nothing is read
+            if num_samples > 0:
+                i1, i2 = get_source_row_range(timestamps, rate=X.rate, starting_time=X.starting_time, num_samples=X.num_samples, method=method, target_rate=rate)
+                if kind == "roi_dff":
+                    values = X.get_dff()[i1:i2]
+                else:
+                    values = X.get_data(i1, i2)
+                values = resample_uniform(values, timestamps, rate=X.rate, starting_time=X.starting_time + i1 / X.rate, method=method, target_rate=rate)
+                data[:, j:j + width] = values.reshape((num_samples, width))
+            j += width
+            if kind == "pupil_radius":
+                labels.append("pupil_radius")
+            else:
+                prefix = "roi" if kind == "roi_responses" else "roi_dff"
+                width = max(3, len(str(X.num_channels)))
+                labels.extend(f"{prefix}_{r + 1:0{width}d}" for r in range(X.num_channels))
+        return data, labels, timestamps
+
+    def publish_shared(self, kinds: List[str] = ["roi_responses", "pupil_radius"], *, acquisition_names: Union[List[str], None] = None):
+        # Reads the series of the given kinds (for every acquisition that has
+        # them) once, into shared memory blocks. Returns a SharedSessionArrays
+        # whose .handles can be passed to worker processes, which get
+        # zero-copy views with attach_shared(handles). Call close() (or use it
+        # as a context manager) once the workers are done, to free the blocks.
+        return publish_session_arrays(self, kinds=kinds, acquisition_names=acquisition_names)
+
+    def preload(self, kinds: List[str] = ["roi_responses", "pupil_radius"], *, acquisition_names: Union[List[str], None] = None, use_cache: bool = True):
+        # Reads the series of the given kinds (for every acquisition that has
+        # them) into memory, and get_data() and everything built on it read
+        # from there afterwards. The arrays are also saved in the cache
+        # directory, so preloading again in a new process is a local read.
+        # Returns a list with one entry per preloaded array.
+        return preload_session_arrays(self, kinds=kinds, acquisition_names=acquisition_names, use_cache=use_cache)
+
+    def get_preloaded_array(self, kind: str, acquisition_name: str):
+        # The array held in memory by preload() (None if not preloaded)
+        return self._preloaded_arrays.get((kind, acquisition_name))
+
+    def set_preloaded_array(self, kind: str, acquisition_name: str, x: np.ndarray):
+        self._preloaded_arrays[(kind, acquisition_name)] = x
+
+    def get_cache_key(self):
+        # Identifies the underlying asset for on-disk caches
+        x = _parse_dandi_asset_url(self.nwb_url, "001256")
+        if x is not None:
+            return x[2]
+        return hashlib.sha1(self.nwb_url.encode("utf-8")).hexdigest()
+
+    def _get_series_cache_key(self, kind: str, acquisition_name: str):
+        return f"{self.get_cache_key()}/{kind}/{acquisition_name}"
+
+    def _get_read_planner(self):
+        if self._read_planner is None and self._use_read_planner:
+            self._read_planner = ReadPlanner(self._file.to_reference_file_system(), local_cache=self._local_cache)
+        return self._read_planner
+
+    def stack_roi_responses(self, acquisition_names: Union[List[str], None] = None, *, num_samples: Union[int, None] = None, dtype=np.float32, out: Union[np.ndarray, None] = None):
+        # Returns an array of shape (num_acquisitions, num_samples, num_rois),
+        # read directly into a single preallocated buffer. By default
+        # num_samples is the smallest number of samples over the acquisitions.
+        if acquisition_names is None:
+            acquisition_names = self.get_acquisition_names()
+        series = [self.get_roi_response_series(a) for a in acquisition_names]
+        if len(series) == 0:
+            raise ValueError("No acquisitions")
+        if num_samples is None:
+            num_samples = min(x.num_samples for x in series)
+        num_channels = series[0].num_channels
+        for a, x in zip(acquisition_names, series):
+            if x.num_channels != num_channels:
+                raise ValueError(f"Unexpected number of ROIs for acquisition {a}: {x.num_channels} != {num_channels}")
+            if x.num_samples < num_samples:
+                raise ValueError(f"Not enough samples for acquisition {a}: {x.num_samples} < {num_samples}")
+        shape = (len(series), num_samples, num_channels)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError(f"Unexpected shape for out: {out.shape} != {shape}")
+        for k, x in enumerate(series):
+            x.get_data(0, num_samples, out=out[k])
+        return out
+
+
+class _RawSeries:
+    # Stands in for the pynwb series object in the wrappers below: the data
+    # dataset plus the rate and starting time from the file attributes
+    def __init__(self, group):
+        self.group = group
+        self.data = group["data"]
+        st = group["starting_time"]
+        self.starting_time = float(st[()])
+        self.rate = float(st.attrs["rate"])
 
 
 class ImageSeries:
-    def __init__(self, obj):
+    def __init__(self, obj, *, planner: Union[ReadPlanner, None] = None, cache_key: Union[str, None] = None):
         self.obj = obj
+        self._planner = planner
+        # identifies the series for on-disk caches (None to disable caching)
+        self._cache_key = cache_key
+        self._local_store: Union[LocalFrameStore, None] = None
+        self._local_store_checked = False
         self.starting_time = obj.starting_time
         self.rate = obj.rate
         self.num_frames = obj.data.shape[0]
         self.frame_shape = obj.data.shape[1:]
 
     def get_frame(self, i):
-        return self.obj.data[i][:, :]
+        store = self._get_local_store()
+        if store is not None:
+            return store.get_frame(i)
+        return _read_selection(self.obj.data, (i,), planner=self._planner)
+
+    def get_frames(self, start: Union[int, None] = None, end: Union[int, None] = None, *, out: Union[np.ndarray, None] = None, dtype=None):
+        store = self._get_local_store()
+        if store is not None:
+            return store.get_frames(start, end, out=out, dtype=dtype)
+        return _read_rows(self.obj.data, start, end, out=out, dtype=dtype, planner=self._planner)
+
+    def cache_locally(self, *, codec: str = "lz4", chunk_frames: int = 1, dtype: Union[str, None] = None, verbose: bool = True):
+        # Copies the whole series into a local compressed store (fetched in
+        # large sequential batches), after which get_frame, get_frames and
+        # get_crop read from it. The store is kept in the cache directory, so
+        # this series in later sessions uses it as well. codec is "lz4",
+        # "zstd", "zlib" or "none"; frames are compressed chunk_frames at a time.
+        # dtype "uint8" or "uint16" transcodes the frames to that dtype (the
+        # values must fit), and None keeps the dtype of the series.
+        directory = self._get_local_store_directory()
+        if directory is None:
+            raise ValueError("This series has no cache key, so it can not be cached locally")
+        if self._local_store is not None:
+            self._local_store.close()
+            self._local_store = None
+        # read from the source while the store is being made
+        self._local_store_checked = True
+        self._local_store = create_local_frame_store(self, directory, codec=codec, chunk_frames=chunk_frames, dtype=dtype, verbose=verbose)
+        return self._local_store
+
+    def _get_local_store(self):
+        if not self._local_store_checked:
+            self._local_store_checked = True
+            directory = self._get_local_store_directory()
+            if directory is not None and os.path.exists(os.path.join(directory, "meta.json")):
+                self._local_store = LocalFrameStore(directory)
+        return self._local_store
+
+    def _get_local_store_directory(self):
+        if self._cache_key is None:
+            return None
+        return os.path.join(get_cache_dir("frame_stores"), hashlib.sha1(self._cache_key.encode("utf-8")).hexdigest())
+
+    def get_crop(self, frames: Union[Tuple[Union[int, None], Union[int, None]], slice], bbox: Tuple[int, int, int, int]):
+        # frames is a (start, end) pair or a slice, and bbox is
+        # (row_start, row_end, col_start, col_end). Returns an array of shape
+        # (num_frames, row_end - row_start, col_end - col_start).
+        if not isinstance(frames, slice):
+            frames = slice(frames[0], frames[1])
+        r1, r2, c1, c2 = bbox
+        store = self._get_local_store()
+        if store is not None:
+            return store.get_frames(*frames.indices(self.num_frames)[:2])[:, r1:r2, c1:c2]
+        return _read_selection(self.obj.data, (frames, slice(r1, r2), slice(c1, c2)), planner=self._planner)
+
+    def get_read_plan(self, selection):
+        # The chunks, bytes and requests that reading the selection would take
+        # (None if the dataset can not be read through the read planner)
+        return _get_read_plan(self.obj.data, selection, planner=self._planner)
 
     def get_timestamps(self):
         return self.starting_time + np.arange(self.num_frames) / self.rate
 
 
 class TimeSeries:
-    def __init__(self, obj):
+    def __init__(self, obj, *, planner: Union[ReadPlanner, None] = None, preloaded: Union[np.ndarray, None] = None):
         self.obj = obj
+        self._planner = planner
+        # the data, if it was preloaded into memory with Session.preload()
+        self._preloaded = preloaded
         self.starting_time = obj.starting_time
         self.rate = obj.rate
         self.num_samples = obj.data.shape[0]
 
-    def get_data(self):
-        return self.obj.data[:]
+    def get_data(self, start: Union[int, None] = None, end: Union[int, None] = None, *, out: Union[np.ndarray, None] = None, dtype=None):
+        if self._preloaded is not None:
+            return _read_preloaded_rows(self._preloaded, start, end, out=out, dtype=dtype)
+        return _read_rows(self.obj.data, start, end, out=out, dtype=dtype, planner=self._planner)
+
+    def get_read_plan(self, selection):
+        return _get_read_plan(self.obj.data, selection, planner=self._planner)
 
     def get_timestamps(self):
         return self.starting_time + np.arange(self.num_samples) / self.rate
 
 
 class MultichannelTimeSeries:
-    def __init__(self, obj):
+    def __init__(self, obj, *, planner: Union[ReadPlanner, None] = None, cache_key: Union[str, None] = None, preloaded: Union[np.ndarray, None] = None):
         self.obj = obj
+        self._planner = planner
+        # identifies the series for on-disk caches (None to disable caching)
+        self._cache_key = cache_key
+        # the data, if it was preloaded into memory with Session.preload()
+        self._preloaded = preloaded
         self.starting_time = obj.starting_time
         self.rate = obj.rate
         self.num_samples = obj.data.shape[0]
         self.num_channels = obj.data.shape[1]
 
-    def get_data(self):
-        return self.obj.data[:]
+    def get_data(self, start: Union[int, None] = None, end: Union[int, None] = None, *, out: Union[np.ndarray, None] = None, dtype=None):
+        if self._preloaded is not None:
+            return _read_preloaded_rows(self._preloaded, start, end, out=out, dtype=dtype)
+        return _read_rows(self.obj.data, start, end, out=out, dtype=dtype, planner=self._planner)
+
+    def get_channel_data(self, channel_index: int, start: Union[int, None] = None, end: Union[int, None] = None, *, out: Union[np.ndarray, None] = None, dtype=None):
+        if self._preloaded is not None:
+            return _read_preloaded_rows(self._preloaded, start, end, out=out, dtype=dtype, column=channel_index)
+        return _read_rows(self.obj.data, start, end, out=out, dtype=dtype, column=channel_index, planner=self._planner)
+
+    def get_dff(self, *, baseline: str = "percentile", window_s: float = 60, q: float = 8, max_workers: Union[int, None] = None, use_cache: bool = True):
+        # dF/F = (F - F0) / F0 for all channels, shape (num_samples, num_channels)
+        # as float32, where the baseline F0 is the q-th percentile (or the
+        # minimum) over a centered sliding window of window_s seconds
+        cache_fname = None
+        if use_cache and self._cache_key is not None:
+            key = json.dumps([self._cache_key, baseline, float(window_s), float(q) if baseline == "percentile" else None])
+            cache_fname = os.path.join(get_cache_dir("dff"), hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npy")
+            if os.path.exists(cache_fname):
+                return np.load(cache_fname)
+        dff = compute_dff(self.get_data(), rate=self.rate, baseline=baseline, window_s=window_s, q=q, max_workers=max_workers)
+        if cache_fname is not None:
+            tmp_fname = cache_fname + ".tmp.npy"
+            np.save(tmp_fname, dff)
+            os.replace(tmp_fname, cache_fname)
+        return dff
+
+    def get_read_plan(self, selection):
+        return _get_read_plan(self.obj.data, selection, planner=self._planner)
 
     def get_timestamps(self):
         return self.starting_time + np.arange(self.num_samples) / self.rate
 
 
+# Blocks of samples for the ROI co-moments are about this many values
+_comoment_block_size_values = 4 * 1024 * 1024
+
+
+def _normalize_windows(window) -> List[Tuple[Union[float, None], Union[float, None]]]:
+    if window is None:
+        return [(None, None)]
+    if len(window) == 2 and not isinstance(window[0], (list, tuple)):
+        window = [window]
+    return [(None if w[0] is None else float(w[0]), None if w[1] is None else float(w[1])) for w in window]
+
+
+def _window_to_sample_range(window, rate: float, num_samples: int):
+    t1, t2 = window
+    i1 = 0 if t1 is None else max(0, int(math.ceil(t1 * rate)))
+    i2 = num_samples if t2 is None else min(num_samples, int(math.ceil(t2 * rate)))
+    return i1, max(i1, i2)
+
+
+def _accumulate_lagged_comoments(acc: RunningCovariance, X: "MultichannelTimeSeries", i1: int, i2: int, lag: int):
+    # pairs (x[t], x[t + lag]) for all t with both t and t + lag in [i1, i2)
+    t1 = max(i1, i1 - lag)
+    t2 = min(i2, i2 - lag)
+    block_size = max(1, _comoment_block_size_values // X.num_channels)
+    for b1 in range(t1, t2, block_size):
+        b2 = min(t2, b1 + block_size)
+        r1 = b1 + min(0, lag)
+        r2 = b2 + max(0, lag)
+        rows = X.get_data(r1, r2)
+        x = rows[b1 - r1:b2 - r1]
+        y = rows[b1 + lag - r1:b2 + lag - r1]
+        acc.add(x, y)
+
+
+# For each series kind: the parent group path and the name prefix of the
+# series within it (the path of the series is <parent>/<prefix><acquisition>).
+# For the motion corrected series, the image series is the "corrected"
+# subgroup.
+_series_locations = {
+    "two_photon": ("/acquisition", "TwoPhotonSeries_", None),
+    "motion_corrected_two_photon": ("/processing/ophys/Motion Corrected TwoPhotonSeries", "motion_corrected_TwoPhotonSeries_", "corrected"),
+    "pupil_video": ("/processing/behavior", "pupil_video_", None),
+    "pupil_radius": ("/processing/behavior/PupilTracking", "pupil_radius_", None),
+    "roi_responses": ("/processing/ophys/Fluorescence", "RoiResponseSeries_", None),
+}
+
+
+def _get_availability(f, acquisition_names: List[str]):
+    availability = {a: {kind: None for kind in _series_locations} for a in acquisition_names}
+    for kind, (parent_path, prefix, subgroup_name) in _series_locations.items():
+        parent = _get_group_or_none(f, parent_path)
+        if parent is None:
+            continue
+        for name in parent.keys():
+            if not name.startswith(prefix):
+                continue
+            a = name[len(prefix):]
+            if a not in availability:
+                continue
+            g = parent[name]
+            if subgroup_name is not None:
+                if subgroup_name not in g:
+                    continue
+                g = g[subgroup_name]
+            if "data" not in g or "starting_time" not in g:
+                continue
+            st = g["starting_time"]
+            availability[a][kind] = {
+                "shape": [int(v) for v in g["data"].shape],
+                "rate": float(st.attrs["rate"]),
+                "starting_time": float(st[()]),
+            }
+    return availability
+
+
+def _get_group_or_none(f, path: str):
+    # walk the path one part at a time, since some backends do not support
+    # get() for paths with missing intermediate groups
+    g = f
+    for part in path.strip("/").split("/"):
+        if part not in g:
+            return None
+        g = g[part]
+    return g
+
+
+# Reading into a preallocated buffer is done in blocks of about this size, so
+# that the only temporary is one block in the stored dtype
+_read_block_size_bytes = 32 * 1024 * 1024
+
+
+def _read_rows(dataset, start: Union[int, None], end: Union[int, None], *, out: Union[np.ndarray, None] = None, dtype=None, column: Union[int, None] = None, planner: Union[ReadPlanner, None] = None):
+    n = dataset.shape[0]
+    i1 = 0 if start is None else start
+    i2 = n if end is None else end
+    if i1 < 0 or i2 > n or i1 > i2:
+        raise ValueError(f"Invalid range [{i1}, {i2}) for {n} rows")
+    # column is an optional index into the second dimension
+    if column is None:
+        selection = (slice(i1, i2),)
+        out_shape = (i2 - i1,) + tuple(dataset.shape[1:])
+    else:
+        selection = (slice(i1, i2), column)
+        out_shape = (i2 - i1,) + tuple(dataset.shape[2:])
+    if out is None:
+        if dtype is None or np.dtype(dtype) == dataset.dtype:
+            return _read_selection(dataset, selection, planner=planner)
+        out = np.empty(out_shape, dtype=dtype)
+    else:
+        if out.shape != out_shape:
+            raise ValueError(f"Unexpected shape for out: {out.shape} != {out_shape}")
+        if dtype is not None and np.dtype(dtype) != out.dtype:
+            raise ValueError(f"dtype {dtype} does not match out.dtype {out.dtype}")
+    if planner is not None and planner.has_dataset(dataset.name):
+        # the planner decodes chunk by chunk directly into out
+        return planner.read(dataset.name, selection, out=out)
+    row_size_bytes = dataset.dtype.itemsize * math.prod(dataset.shape[1:])
+    rows_per_block = max(1, _read_block_size_bytes // max(1, row_size_bytes))
+    for j1 in range(i1, i2, rows_per_block):
+        j2 = min(i2, j1 + rows_per_block)
+        out[j1 - i1:j2 - i1] = dataset[(slice(j1, j2),) + selection[1:]]
+    return out
+
+
+def _read_preloaded_rows(x: np.ndarray, start: Union[int, None], end: Union[int, None], *, out: Union[np.ndarray, None] = None, dtype=None, column: Union[int, None] = None):
+    # The preloaded array is shared by every reader of the series, so return
+    # a copy rather than a view into it
+    ret = _read_rows(x, start, end, out=out, dtype=dtype, column=column)
+    return ret.copy() if np.shares_memory(ret, x) else ret
+
+
+def _read_selection(dataset, selection: tuple, *, planner: Union[ReadPlanner, None] = None):
+    if planner is not None and planner.has_dataset(dataset.name):
+        return planner.read(dataset.name, selection)
+    return dataset[selection]
+
+
+def _get_read_plan(dataset, selection, *, planner: Union[ReadPlanner, None] = None):
+    if planner is None or not planner.has_dataset(dataset.name):
+        return None
+    return planner.plan(dataset.name, selection)
+
+
 _session_cache = {}
 
 
-def load_session(*, nwb_url: str):
-    if nwb_url in _session_cache:
-        return _session_cache[nwb_url]
-    S = Session(nwb_url=nwb_url)
-    _session_cache[nwb_url] = S
+def load_session(*, nwb_url: str, local_cache: Union["lindi.LocalCache", None] = None, backend: str = "pynwb"):
+    key = (nwb_url, backend)
+    if key in _session_cache:
+        return _session_cache[key]
+    S = Session(nwb_url=nwb_url, local_cache=local_cache, backend=backend)
+    _session_cache[key] = S
     return S
 
 
 def _try_get_lindi_url(nwb_url: str, dandiset_id: str):
     if nwb_url.endswith(".lindi.json") or nwb_url.endswith(".lindi.tar"):
         return nwb_url
+    x = _parse_dandi_asset_url(nwb_url, dandiset_id)
+    if x is None:
+        return None
+    staging, dandiset_id, asset_id = x
+    aa = "dandi-staging" if staging else "dandi"
+    try_url = f"https://lindi.neurosift.org/{aa}/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json"
+    file_exists = _check_url_exists(try_url)
+    if file_exists:
+        return try_url
+    return None
+
+
+def _get_local_lindi_file_path(nwb_url: str, dandiset_id: str):
+    # Where the local copy of the lindi file for a DANDI asset goes (downloaded
+    # or generated), keyed by asset id and dandiset version (None if this is
+    # not a DANDI asset URL)
+    x = _parse_dandi_asset_url(nwb_url, dandiset_id)
+    if x is None:
+        return None
+    staging, dandiset_id, asset_id = x
+    parts = nwb_url.split("/")
+    version = parts[parts.index("versions") + 1] if "versions" in parts else dandiset_version
+    aa = "dandi-staging" if staging else "dandi"
+    return os.path.join(get_cache_dir("lindi_files", aa, dandiset_id, version), f"{asset_id}.lindi.json")
+
+
+def _download_lindi_file(lindi_url: str, path: str):
+    # Returns the path, or None if the file could not be downloaded (in which
+    # case the session reads the remote lindi file)
+    try:
+        resp = get_default_remote_reader().request("GET", lindi_url, hedge=False)
+        json.loads(resp.content)
+    except Exception as e:
+        print(f"Could not download {lindi_url}: {e}")
+        return None
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as ff:
+        ff.write(resp.content)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _generate_local_lindi_file(nwb_url: str, path: str, *, local_cache: Union["lindi.LocalCache", None] = None):
+    # Returns the path, or None if the file could not be generated (in which
+    # case the session falls back to reading the HDF5 file directly)
+    import lindi
+
+    try:
+        f = lindi.LindiH5pyFile.from_hdf5_file(nwb_url, local_cache=local_cache)
+        rfs = f.to_reference_file_system()
+        f.close()
+    except Exception as e:
+        print(f"Could not generate a lindi file for {nwb_url}: {e}")
+        return None
+    # write to a temporary file first, so that concurrent sessions never see
+    # a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as ff:
+        json.dump(rfs, ff)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _parse_dandi_asset_url(nwb_url: str, dandiset_id: str):
+    # Returns (staging, dandiset_id, asset_id), or None if this is not a DANDI asset URL
     asset_id = None
     staging = None
     if nwb_url.startswith("https://api-staging.dandiarchive.org/api/assets/"):
@@ -133,16 +793,11 @@ def _try_get_lindi_url(nwb_url: str, dandiset_id: str):
         return None
     if not asset_id:
         return None
-    aa = "dandi-staging" if staging else "dandi"
-    try_url = f"https://lindi.neurosift.org/{aa}/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json"
-    file_exists = _check_url_exists(try_url)
-    if file_exists:
-        return try_url
-    return None
+    return staging, dandiset_id, asset_id
 
 
 def _check_url_exists(url: str):
-    resp = requests.head(url)
+    resp = get_default_remote_reader().head(url)
     return resp.ok
 
 
@@ -192,6 +847,15 @@ def example_usage():
     # pupil_video_frame = pupil_video.get_frame(0)  # shape: (height, width)
     # pupil_radius_data = pupil_radius.get_data()  # shape: (num_samples,)
     # data = roi_response_series.get_data()  # shape: (num_samples, num_channels)
+    # data = roi_response_series.get_data(0, 1000, dtype=np.float32)  # first 1000 samples as float32
+    # frames = two_photon_series.get_frames(0, 10)  # shape: (10, height, width)
+    # X = S.stack_roi_responses(dtype=np.float32)  # shape: (num_acquisitions, num_samples, num_channels)
+    # dff = roi_response_series.get_dff(baseline="percentile", window_s=60, q=8)  # shape: (num_samples, num_channels)
+    # data, labels, timestamps = S.get_joint_timeseries("000", rate=10, kinds=["pupil_radius", "roi_responses"])  # shape: (num_samples, 1 + num_rois)
+    # pupil_video.cache_locally()  # local compressed copy, for fast random access with get_frame
+    # movie = S.get_roi_movie("000", 27, pad=5)  # frames cropped to ROI 27, shape: (num_frames, h, w)
+    # C = S.roi_correlation(window=(0, 10), lag=0)  # ROI-by-ROI correlation, pooled over acquisitions
+    # S.preload(["roi_responses", "pupil_radius"])  # keep these series in memory (and in the local cache) for repeated reads
 
     # For convenience, to get the timestamps:
     # timestamps = two_photon_series.get_timestamps()  # shape: (num_frames,)
@@ -1,2 +1,46 @@
-from .Session import load_session  # noqa
-from .get_dandiset_info import get_dandiset_info  # noqa
+import importlib
+import sys
+import types
+
+# The public names are imported from their modules on first access, so that
+# importing the package does not import numpy, pynwb, lindi or requests.
+_lazy_attributes = {
+    "load_session": "Session",
+    "get_dandiset_info": "get_dandiset_info",
+    "serve": "serve",
+    "build_dandiset_index": "dandiset_index",
+    "DandisetIndex": "dandiset_index",
+    "reduce_dandiset": "reduce_dandiset",
+    "attach_shared": "shared_arrays",
+    "configure_remote_reads": "remote_reader",
+    "warmup": "warmup",
+}
+
+__all__ = list(_lazy_attributes)
+
+
+def __getattr__(name: str):
+    if name not in _lazy_attributes:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f".{_lazy_attributes[name]}", __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
+
+
+class _Package(types.ModuleType):
+    # Importing a submodule binds it as an attribute of the package. Some
+    # submodules have the same name as the function they provide (e.g.
+    # get_dandiset_info), so bind the function instead, as an eager
+    # "from .get_dandiset_info import get_dandiset_info" would have.
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) and _lazy_attributes.get(name) == name and value.__name__ == f"{__name__}.{name}":
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
@@ -0,0 +1,150 @@
+from typing import Tuple
+import numpy as np
+
+
+# Per-bin count, mean and sum of squared deviations (M2), updated a block at a
+# time and merged with the pairwise formulas of Chan et al., so that partial
+# results computed in any order (or in different processes) combine exactly.
+class BinnedStats:
+    def __init__(self, num_bins: int):
+        self.num_bins = num_bins
+        self.count = np.zeros(num_bins, dtype=np.int64)
+        self.mean = np.zeros(num_bins, dtype=np.float64)
+        self.m2 = np.zeros(num_bins, dtype=np.float64)
+
+    def add(self, bin_indices: np.ndarray, values: np.ndarray):
+        # bin_indices and values have the same shape. Values that are NaN or
+        # that have a bin index outside [0, num_bins) are ignored.
+        bin_indices = np.asarray(bin_indices).ravel()
+        values = np.asarray(values, dtype=np.float64).ravel()
+        keep = (bin_indices >= 0) & (bin_indices < self.num_bins) & ~np.isnan(values)
+        bin_indices = bin_indices[keep]
+        values = values[keep]
+        count_b = np.bincount(bin_indices, minlength=self.num_bins)
+        sum_b = np.bincount(bin_indices, weights=values, minlength=self.num_bins)
+        mean_b = np.divide(sum_b, count_b, out=np.zeros(self.num_bins), where=count_b > 0)
+        m2_b = np.bincount(bin_indices, weights=(values - mean_b[bin_indices]) ** 2, minlength=self.num_bins)
+        self._merge(count_b, mean_b, m2_b)
+
+    def merge(self, other: "BinnedStats"):
+        if other.num_bins != self.num_bins:
+            raise ValueError(f"Mismatch in number of bins: {other.num_bins} != {self.num_bins}")
+        self._merge(other.count, other.mean, other.m2)
+
+    def _merge(self, count_b: np.ndarray, mean_b: np.ndarray, m2_b: np.ndarray):
+        count = self.count + count_b
+        delta = mean_b - self.mean
+        frac_b = np.divide(count_b, count, out=np.zeros(self.num_bins), where=count > 0)
+        self.mean = self.mean + delta * frac_b
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.count * frac_b
+        self.count = count
+
+    def get_mean(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def get_var(self, ddof: int = 0):
+        return np.divide(self.m2, self.count - ddof, out=np.full(self.num_bins, np.nan), where=self.count > ddof)
+
+    def get_std(self, ddof: int = 0):
+        return np.sqrt(self.get_var(ddof=ddof))
+
+    def get_stats(self, stats: Tuple[str, ...], *, ddof: int = 0):
+        ret = {}
+        for s in stats:
+            if s == "mean":
+                ret[s] = self.get_mean()
+            elif s == "var":
+                ret[s] = self.get_var(ddof=ddof)
+            elif s == "std":
+                ret[s] = self.get_std(ddof=ddof)
+            elif s == "count":
+                ret[s] = self.count.copy()
+            else:
+                raise ValueError(f"Unexpected statistic: {s}")
+        return ret
+
+
+# Running means, sums of squared deviations and co-moment matrix for paired
+# multichannel samples (x, y), where the co-moment is
+# C = sum over samples of (x - mean_x)(y - mean_y)^T. Like BinnedStats, blocks
+# are combined with the Chan et al. pairwise formulas, so memory use only
+# depends on the number of channels.
+class RunningCovariance:
+    def __init__(self, num_channels: int):
+        self.num_channels = num_channels
+        self.count = 0
+        self.mean_x = np.zeros(num_channels, dtype=np.float64)
+        self.mean_y = np.zeros(num_channels, dtype=np.float64)
+        self.m2_x = np.zeros(num_channels, dtype=np.float64)
+        self.m2_y = np.zeros(num_channels, dtype=np.float64)
+        self.comoment = np.zeros((num_channels, num_channels), dtype=np.float64)
+
+    def add(self, x: np.ndarray, y: np.ndarray):
+        # x and y have shape (num_samples, num_channels), where row i of y is
+        # paired with row i of x. Rows with any NaN are ignored.
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if x.shape != y.shape or x.ndim != 2 or x.shape[1] != self.num_channels:
+            raise ValueError(f"Unexpected shapes: {x.shape}, {y.shape}")
+        keep = ~(np.isnan(x).any(axis=1) | np.isnan(y).any(axis=1))
+        if not keep.all():
+            x = x[keep]
+            y = y[keep]
+        if x.shape[0] == 0:
+            return
+        b = RunningCovariance(self.num_channels)
+        b.count = x.shape[0]
+        b.mean_x = x.mean(axis=0)
+        b.mean_y = y.mean(axis=0)
+        dx = x - b.mean_x
+        dy = y - b.mean_y
+        b.m2_x = np.einsum("ij,ij->j", dx, dx)
+        b.m2_y = np.einsum("ij,ij->j", dy, dy)
+        b.comoment = dx.T @ dy
+        self.merge(b)
+
+    def merge(self, other: "RunningCovariance"):
+        if other.num_channels != self.num_channels:
+            raise ValueError(f"Mismatch in number of channels: {other.num_channels} != {self.num_channels}")
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta_x = other.mean_x - self.mean_x
+        delta_y = other.mean_y - self.mean_y
+        f = self.count * other.count / count
+        self.comoment = self.comoment + other.comoment + np.outer(delta_x, delta_y) * f
+        self.m2_x = self.m2_x + other.m2_x + delta_x ** 2 * f
+        self.m2_y = self.m2_y + other.m2_y + delta_y ** 2 * f
+        self.mean_x = self.mean_x + delta_x * (other.count / count)
+        self.mean_y = self.mean_y + delta_y * (other.count / count)
+        self.count = count
+
+    def get_covariance(self, ddof: int = 1):
+        if self.count <= ddof:
+            return np.full((self.num_channels, self.num_channels), np.nan)
+        return self.comoment / (self.count - ddof)
+
+    def get_correlation(self):
+        denom = np.sqrt(np.outer(self.m2_x, self.m2_y))
+        return np.divide(self.comoment, denom, out=np.full_like(self.comoment, np.nan), where=denom > 0)
+
+    def to_dict(self):
+        return {
+            "count": np.array(self.count),
+            "mean_x": self.mean_x,
+            "mean_y": self.mean_y,
+            "m2_x": self.m2_x,
+            "m2_y": self.m2_y,
+            "comoment": self.comoment,
+        }
+
+    @staticmethod
+    def from_dict(d) -> "RunningCovariance":
+        ret = RunningCovariance(len(d["mean_x"]))
+        ret.count = int(d["count"])
+        ret.mean_x = np.array(d["mean_x"], dtype=np.float64)
+        ret.mean_y = np.array(d["mean_y"], dtype=np.float64)
+        ret.m2_x = np.array(d["m2_x"], dtype=np.float64)
+        ret.m2_y = np.array(d["m2_y"], dtype=np.float64)
+        ret.comoment = np.array(d["comoment"], dtype=np.float64)
+        return ret
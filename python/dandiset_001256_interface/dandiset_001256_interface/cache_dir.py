@@ -0,0 +1,8 @@
+import os
+
+
+def get_cache_dir(*subdirs: str):
+    base_dir = os.environ.get("DANDISET_001256_CACHE_DIR", os.path.expanduser("~/.cache/dandiset_001256_interface"))
+    cache_dir = os.path.join(base_dir, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
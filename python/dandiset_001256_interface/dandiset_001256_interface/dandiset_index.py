@@ -0,0 +1,220 @@
+import json
+import os
+import sqlite3
+import time
+from typing import List, Union
+from .Session import Session
+from .cache_dir import get_cache_dir
+from .get_dandiset_info import get_dandiset_info
+
+
+# The series kinds recorded for each acquisition
+series_kinds = ["two_photon", "motion_corrected_two_photon", "pupil_video", "pupil_radius", "roi_responses"]
+
+# Bump this when the tables or the way rows are computed change. An index
+# built with a different version (or different series_kinds) is rebuilt.
+_schema_version = 1
+
+_data_tables = ["sessions", "acquisitions", "series"]
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    asset_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    asset_path TEXT NOT NULL,
+    asset_url TEXT NOT NULL,
+    num_acquisitions INTEGER NOT NULL,
+    num_rois INTEGER,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS acquisitions (
+    asset_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    acquisition_name TEXT NOT NULL,
+    num_rois INTEGER,
+    missing TEXT NOT NULL,
+    PRIMARY KEY (asset_id, acquisition_name)
+);
+CREATE TABLE IF NOT EXISTS series (
+    asset_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    acquisition_name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    rate REAL NOT NULL,
+    starting_time REAL NOT NULL,
+    num_samples INTEGER NOT NULL,
+    PRIMARY KEY (asset_id, acquisition_name, kind)
+);
+CREATE INDEX IF NOT EXISTS acquisitions_session_id ON acquisitions (session_id);
+CREATE INDEX IF NOT EXISTS series_session_id ON series (session_id);
+"""
+
+
+def get_default_index_path():
+    return os.path.join(get_cache_dir(), "dandiset_index.db")
+
+
+def build_dandiset_index(*, index_path: Union[str, None] = None, refresh: bool = False, verbose: bool = True):
+    # Sessions are keyed by asset_id, and assets are immutable, so only
+    # sessions that are not yet in the index need to be opened (unless
+    # refresh is True)
+    if index_path is None:
+        index_path = get_default_index_path()
+    info = get_dandiset_info()
+    sessions = info["sessions"]
+    conn = sqlite3.connect(index_path)
+    try:
+        _check_schema(conn, verbose=verbose)
+        current_asset_ids = set(s["asset_id"] for s in sessions)
+        indexed_asset_ids = set(r[0] for r in conn.execute("SELECT asset_id FROM sessions"))
+        for asset_id in indexed_asset_ids - current_asset_ids:
+            _delete_session(conn, asset_id)
+        conn.commit()
+        for i, s in enumerate(sessions):
+            if s["asset_id"] in indexed_asset_ids and not refresh:
+                continue
+            if verbose:
+                print(f"Indexing session {i + 1} of {len(sessions)}: {s['session_id']}")
+            S = Session(nwb_url=s["asset_url"], backend="raw")
+            acquisitions = _get_session_metadata(S)
+            del S
+            _delete_session(conn, s["asset_id"])
+            _insert_session(conn, s, acquisitions)
+            # commit per session so that an interrupted build can be resumed
+            conn.commit()
+    finally:
+        conn.close()
+    return DandisetIndex(index_path=index_path)
+
+
+def _check_schema(conn: sqlite3.Connection, *, verbose: bool):
+    # Drops the data tables of an index built with a different schema (or
+    # before the schema was recorded), so that every session is indexed again
+    schema = json.dumps({"version": _schema_version, "series_kinds": series_kinds})
+    conn.executescript(_schema)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+    if row is not None and row[0] == schema:
+        return
+    if verbose and conn.execute("SELECT 1 FROM sessions LIMIT 1").fetchone() is not None:
+        print("The index was built with a different schema; indexing all sessions again")
+    for table in _data_tables:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.executescript(_schema)
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)", (schema,))
+    conn.commit()
+
+
+def _get_session_metadata(S: Session):
+    availability = S.get_availability()
+    acquisitions = []
+    for name in S.get_acquisition_names():
+        series = {}
+        for kind, x in availability[name].items():
+            if x is None:
+                continue
+            series[kind] = {**x, "num_samples": x["shape"][0]}
+        acquisitions.append({
+            "acquisition_name": name,
+            "series": series,
+        })
+    return acquisitions
+
+
+def _insert_session(conn: sqlite3.Connection, s: dict, acquisitions: list):
+    num_rois = None
+    for a in acquisitions:
+        if "roi_responses" in a["series"]:
+            num_rois = a["series"]["roi_responses"]["shape"][1]
+            break
+    conn.execute(
+        "INSERT INTO sessions (asset_id, session_id, asset_path, asset_url, num_acquisitions, num_rois, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (s["asset_id"], s["session_id"], s["asset_path"], s["asset_url"], len(acquisitions), num_rois, time.time())
+    )
+    for a in acquisitions:
+        series = a["series"]
+        missing = [k for k in series_kinds if k not in series]
+        a_num_rois = series["roi_responses"]["shape"][1] if "roi_responses" in series else None
+        conn.execute(
+            "INSERT INTO acquisitions (asset_id, session_id, acquisition_name, num_rois, missing) VALUES (?, ?, ?, ?, ?)",
+            (s["asset_id"], s["session_id"], a["acquisition_name"], a_num_rois, json.dumps(missing))
+        )
+        for kind, x in series.items():
+            conn.execute(
+                "INSERT INTO series (asset_id, session_id, acquisition_name, kind, shape, rate, starting_time, num_samples) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (s["asset_id"], s["session_id"], a["acquisition_name"], kind, json.dumps(x["shape"]), x["rate"], x["starting_time"], x["num_samples"])
+            )
+
+
+def _delete_session(conn: sqlite3.Connection, asset_id: str):
+    for table in _data_tables:
+        conn.execute(f"DELETE FROM {table} WHERE asset_id = ?", (asset_id,))
+
+
+class DandisetIndex:
+    def __init__(self, *, index_path: Union[str, None] = None):
+        if index_path is None:
+            index_path = get_default_index_path()
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"Index not found: {index_path} (use build_dandiset_index() to create it)")
+        self.index_path = index_path
+        self._conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+
+    def get_sessions(self):
+        rows = self._conn.execute("SELECT * FROM sessions ORDER BY asset_path").fetchall()
+        return [dict(r) for r in rows]
+
+    def get_acquisitions(self, *, session_id: Union[str, None] = None, require: Union[List[str], None] = None):
+        # require is a list of series kinds that must be present, e.g. ["pupil_radius"]
+        where = []
+        params = []
+        if session_id is not None:
+            where.append("a.session_id = ?")
+            params.append(session_id)
+        for kind in require or []:
+            if kind not in series_kinds:
+                raise ValueError(f"Unexpected series kind: {kind}")
+            where.append("EXISTS (SELECT 1 FROM series s WHERE s.asset_id = a.asset_id AND s.acquisition_name = a.acquisition_name AND s.kind = ?)")
+            params.append(kind)
+        sql = "SELECT a.* FROM acquisitions a JOIN sessions ss ON ss.asset_id = a.asset_id"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ss.asset_path, a.acquisition_name"
+        acquisitions = [dict(r) for r in self._conn.execute(sql, params)]
+        series_by_key = {}
+        for r in self._conn.execute("SELECT * FROM series" + (" WHERE session_id = ?" if session_id is not None else ""), [session_id] if session_id is not None else []):
+            series_by_key.setdefault((r["asset_id"], r["acquisition_name"]), {})[r["kind"]] = {
+                "shape": json.loads(r["shape"]),
+                "rate": r["rate"],
+                "starting_time": r["starting_time"],
+                "num_samples": r["num_samples"],
+            }
+        for a in acquisitions:
+            a["missing"] = json.loads(a["missing"])
+            a["series"] = series_by_key.get((a["asset_id"], a["acquisition_name"]), {})
+        return acquisitions
+
+    def query(self, sql: str, params: Union[list, tuple] = ()):
+        return [dict(r) for r in self._conn.execute(sql, params)]
+
+    def close(self):
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or update the local metadata index for dandiset 001256")
+    parser.add_argument("--index-path", default=None, help="Path to the SQLite index (default: in the cache directory)")
+    parser.add_argument("--refresh", action="store_true", help="Re-index sessions that are already in the index")
+    args = parser.parse_args()
+    X = build_dandiset_index(index_path=args.index_path, refresh=args.refresh)
+    sessions = X.get_sessions()
+    print(f"Indexed {len(sessions)} sessions in {X.index_path}")
+    for s in sessions:
+        print(f"{s['session_id']}: {s['num_acquisitions']} acquisitions, {s['num_rois']} ROIs")
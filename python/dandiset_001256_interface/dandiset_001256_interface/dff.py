@@ -0,0 +1,160 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+import numpy as np
+
+
+dff_baselines = ["percentile", "minimum"]
+
+# Channels are processed in groups, so that the working memory of the sliding
+# percentile (an int32 per sample, channel and bit of the sample index, plus
+# a few int32 per sample and channel for the queries) stays
+# around this size
+_max_group_bytes = 256 * 1024 * 1024
+
+
+def compute_dff(
+    data: np.ndarray,
+    *,
+    rate: float,
+    baseline: str = "percentile",
+    window_s: float = 60,
+    q: float = 8,
+    max_workers: Union[int, None] = None
+):
+    # data has shape (num_samples, num_channels). The baseline F0 is the q-th
+    # percentile (or the minimum) of each channel over a centered window of
+    # window_s seconds, truncated at the start and end of the recording, and
+    # the result is (F - F0) / F0 as float32. All channels are processed at
+    # once; with max_workers > 1 the channels are split across processes.
+    if baseline not in dff_baselines:
+        raise ValueError(f"Unexpected baseline: {baseline}")
+    if data.ndim != 2:
+        raise ValueError(f"Expected 2D data, got shape {data.shape}")
+    half_window = max(0, int(round(window_s * rate / 2)))
+    num_channels = data.shape[1]
+    if max_workers is None or max_workers <= 1 or num_channels < 2:
+        return _compute_dff(data, baseline=baseline, half_window=half_window, q=q)
+    out = np.empty(data.shape, dtype=np.float32)
+    boundaries = np.linspace(0, num_channels, min(max_workers, num_channels) + 1).astype(int)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            (c1, c2, executor.submit(_compute_dff, np.ascontiguousarray(data[:, c1:c2]), baseline=baseline, half_window=half_window, q=q))
+            for c1, c2 in zip(boundaries[:-1], boundaries[1:])
+        ]
+        for c1, c2, future in futures:
+            out[:, c1:c2] = future.result()
+    return out
+
+
+def _compute_dff(data: np.ndarray, *, baseline: str, half_window: int, q: float):
+    num_samples, num_channels = data.shape
+    out = np.empty(data.shape, dtype=np.float32)
+    num_levels = max(1, int(num_samples - 1).bit_length())
+    group_size = max(1, _max_group_bytes // ((4 * num_levels + 48) * max(1, num_samples)))
+    for c1 in range(0, num_channels, group_size):
+        c2 = min(num_channels, c1 + group_size)
+        x = np.asarray(data[:, c1:c2], dtype=np.float64)
+        if baseline == "percentile":
+            f0 = sliding_percentile(x, half_window, q)
+        else:
+            f0 = sliding_minimum(x, half_window)
+        out[:, c1:c2] = (x - f0) / f0
+    return out
+
+
+def sliding_minimum(x: np.ndarray, half_window: int):
+    # van Herk / Gil-Werman: running minima within blocks of the window length,
+    # forward and backward, so each output is the min of two values, O(n)
+    # regardless of the window length. The edges are padded with +inf, which
+    # truncates the window there.
+    num_samples = x.shape[0]
+    w = 2 * half_window + 1
+    if w == 1 or num_samples == 0:
+        return x.copy()
+    num_blocks = -(-(num_samples + 2 * half_window) // w)
+    padded = np.full((num_blocks * w,) + x.shape[1:], np.inf, dtype=x.dtype)
+    padded[half_window:half_window + num_samples] = x
+    blocks = padded.reshape((num_blocks, w) + x.shape[1:])
+    forward = np.minimum.accumulate(blocks, axis=1).reshape(padded.shape)
+    backward = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(padded.shape)
+    # the window of output i is padded[i:i + w]
+    return np.minimum(backward[:num_samples], forward[w - 1:w - 1 + num_samples])
+
+
+def sliding_percentile(x: np.ndarray, half_window: int, q: float):
+    # The q-th percentile (linear interpolation, as in np.percentile) of
+    # x[i - half_window:i + half_window + 1] for every i, per column.
+    #
+    # Each column is replaced by the ranks of its values, and a wavelet matrix
+    # over the ranks answers "k-th smallest in [lo, hi)" in one pass per bit.
+    # All windows and all columns are queried at once, so the cost is
+    # O(n log n) numpy work per column and independent of the window length.
+    if x.ndim == 1:
+        return sliding_percentile(x[:, None], half_window, q)[:, 0]
+    num_samples, num_channels = x.shape
+    if num_samples == 0:
+        return x.copy()
+    # channel-major, so that each channel's lookups stay in a contiguous row
+    xt = np.ascontiguousarray(x.T)
+    order = np.argsort(xt, axis=1, kind="stable")
+    sorted_xt = np.take_along_axis(xt, order, axis=1)
+    ranks = np.empty(xt.shape, dtype=np.int32)
+    np.put_along_axis(ranks, order, np.arange(num_samples, dtype=np.int32)[None, :], axis=1)
+    matrix = _WaveletMatrix(ranks)
+
+    i = np.arange(num_samples)
+    lo = np.maximum(0, i - half_window)
+    hi = np.minimum(num_samples, i + half_window + 1)
+    p = (q / 100) * (hi - lo - 1)
+    k_lo = np.floor(p).astype(np.int32)
+    k_hi = np.minimum(k_lo + 1, hi - lo - 1).astype(np.int32)
+    frac = p - k_lo
+    v_lo = np.take_along_axis(sorted_xt, matrix.kth_smallest(lo, hi, k_lo), axis=1)
+    v_hi = np.take_along_axis(sorted_xt, matrix.kth_smallest(lo, hi, k_hi), axis=1)
+    return (v_lo + frac[None, :] * (v_hi - v_lo)).T
+
+
+class _WaveletMatrix:
+    # Row-wise wavelet matrices over non-negative integers < 2 ** num_levels
+    def __init__(self, values: np.ndarray):
+        num_rows, n = values.shape
+        self.num_levels = max(1, int(n - 1).bit_length())
+        self.num_zeros = np.empty((self.num_levels, num_rows, 1), dtype=np.int32)
+        # zeros_before[l, r, i]: number of zero bits at level l in the first i entries of row r
+        self.zeros_before = np.zeros((self.num_levels, num_rows, n + 1), dtype=np.int32)
+        v = values
+        rows = np.arange(num_rows)[:, None]
+        positions = np.arange(n, dtype=np.int32)[None, :]
+        for level in range(self.num_levels):
+            bits = (v >> (self.num_levels - 1 - level)) & 1
+            np.cumsum(1 - bits, axis=1, out=self.zeros_before[level, :, 1:])
+            zeros_before = self.zeros_before[level, :, :n]
+            nz = self.zeros_before[level, :, n:]
+            self.num_zeros[level] = nz
+            # stable partition: zeros first, then ones
+            new_pos = np.where(bits == 0, zeros_before, nz + positions - zeros_before)
+            v2 = np.empty_like(v)
+            v2[rows, new_pos] = v
+            v = v2
+
+    def kth_smallest(self, lo: np.ndarray, hi: np.ndarray, k: np.ndarray):
+        # lo, hi, k have shape (num_queries,) and are the same for every row;
+        # k is 0-based. Returns shape (num_rows, num_queries).
+        num_rows = self.zeros_before.shape[1]
+        lo = np.repeat(lo.astype(np.int32)[None, :], num_rows, axis=0)
+        hi = np.repeat(hi.astype(np.int32)[None, :], num_rows, axis=0)
+        k = np.repeat(k.astype(np.int32)[None, :], num_rows, axis=0)
+        result = np.zeros(lo.shape, dtype=np.int32)
+        for level in range(self.num_levels):
+            z = self.zeros_before[level]
+            z_lo = np.take_along_axis(z, lo, axis=1)
+            z_hi = np.take_along_axis(z, hi, axis=1)
+            num_zeros_in_range = z_hi - z_lo
+            go_right = k >= num_zeros_in_range
+            nz = self.num_zeros[level]
+            k = np.where(go_right, k - num_zeros_in_range, k)
+            lo = np.where(go_right, nz + lo - z_lo, z_lo)
+            hi = np.where(go_right, nz + hi - z_hi, z_hi)
+            result = (result << 1) | go_right
+        return result
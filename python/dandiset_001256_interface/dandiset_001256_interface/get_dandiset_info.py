@@ -1,9 +1,10 @@
-import requests
+dandiset_id = '001256'
+dandiset_version = '0.241120.2150'
 
 
 def get_dandiset_info():
-    dandiset_id = '001256'
-    dandiset_version = '0.241120.2150'
+    import requests
+
     url = f'https://api.dandiarchive.org/api/dandisets/{dandiset_id}/versions/{dandiset_version}/assets/?order=path&metadata=false'
     response = requests.get(url)
     if response.status_code != 200:
@@ -0,0 +1,181 @@
+import json
+import mmap
+import os
+import shutil
+from typing import Union
+import numpy as np
+
+
+# A local copy of an image series: the frames are stored in chunks of
+# chunk_frames frames, each compressed with a numcodecs codec and appended to
+# one data file, with the byte offsets of the chunks in a separate index. The
+# data file is memory mapped, so reading a frame is one decode of its chunk.
+# The frames can be transcoded to a smaller integer dtype (uint8 or uint16) on
+# the way in.
+#
+#   <directory>/meta.json     shape, dtype (as stored), codec, chunk_frames
+#   <directory>/offsets.npy   num_chunks + 1 byte offsets into data.bin
+#   <directory>/data.bin      the compressed chunks
+
+frame_store_codecs = ["lz4", "zstd", "zlib", "none"]
+frame_store_dtypes = ["uint8", "uint16"]
+
+# Frames are fetched from the source series in batches of about this size
+_fetch_batch_bytes = 64 * 1024 * 1024
+
+
+class LocalFrameStore:
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.shape = tuple(meta["shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.codec_name = meta["codec"]
+        self.chunk_frames = meta["chunk_frames"]
+        self.num_frames = self.shape[0]
+        self.frame_shape = self.shape[1:]
+        self._offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self._codec = _get_codec(self.codec_name)
+        self._file = open(os.path.join(directory, "data.bin"), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        # (chunk_index, frames) of the most recently decoded chunk, for
+        # frame-by-frame scrubbing. It is replaced as a whole, so threads
+        # reading the store never see the index of one chunk with the frames
+        # of another.
+        self._last_chunk = (-1, None)
+
+    @property
+    def num_bytes(self):
+        return int(self._offsets[-1])
+
+    def get_frame(self, i: int):
+        if i < 0:
+            i += self.num_frames
+        if i < 0 or i >= self.num_frames:
+            raise IndexError(f"Frame index {i} out of range for {self.num_frames} frames")
+        chunk = self._get_chunk(i // self.chunk_frames)
+        return chunk[i % self.chunk_frames].copy()
+
+    def get_frames(self, start: Union[int, None] = None, end: Union[int, None] = None, *, out: Union[np.ndarray, None] = None, dtype=None):
+        i1 = 0 if start is None else start
+        i2 = self.num_frames if end is None else end
+        if i1 < 0 or i2 > self.num_frames or i1 > i2:
+            raise ValueError(f"Invalid range [{i1}, {i2}) for {self.num_frames} frames")
+        out_shape = (i2 - i1,) + tuple(self.frame_shape)
+        if out is None:
+            out = np.empty(out_shape, dtype=dtype if dtype is not None else self.dtype)
+        elif out.shape != out_shape:
+            raise ValueError(f"Unexpected shape for out: {out.shape} != {out_shape}")
+        for c in range(i1 // self.chunk_frames, -(-i2 // self.chunk_frames) if i2 > i1 else 0):
+            chunk = self._get_chunk(c)
+            j1 = max(i1, c * self.chunk_frames)
+            j2 = min(i2, (c + 1) * self.chunk_frames)
+            out[j1 - i1:j2 - i1] = chunk[j1 - c * self.chunk_frames:j2 - c * self.chunk_frames]
+        return out
+
+    def _get_chunk(self, chunk_index: int):
+        last_chunk_index, last_chunk = self._last_chunk
+        if chunk_index == last_chunk_index:
+            return last_chunk
+        assert self._mmap is not None
+        buf = self._mmap[self._offsets[chunk_index]:self._offsets[chunk_index + 1]]
+        if self._codec is not None:
+            buf = self._codec.decode(buf)
+        num_frames = min(self.chunk_frames, self.num_frames - chunk_index * self.chunk_frames)
+        chunk = np.frombuffer(buf, dtype=self.dtype).reshape((num_frames,) + tuple(self.frame_shape))
+        self._last_chunk = (chunk_index, chunk)
+        return chunk
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+def create_local_frame_store(X, directory: str, *, codec: str = "lz4", chunk_frames: int = 1, dtype: Union[str, None] = None, verbose: bool = True):
+    # Transcodes the image series X (anything with num_frames, frame_shape
+    # and get_frames) into a LocalFrameStore at directory, or opens the
+    # existing one if it was made with the same parameters. dtype is None
+    # (keep the source dtype) or one of frame_store_dtypes; the values are
+    # rounded, and must fit in the range of that dtype.
+    if codec not in frame_store_codecs:
+        raise ValueError(f"Unexpected codec: {codec}")
+    if chunk_frames < 1:
+        raise ValueError("chunk_frames must be at least 1")
+    if dtype is not None and dtype not in frame_store_dtypes:
+        raise ValueError(f"Unexpected dtype: {dtype}")
+    source = X.obj.data
+    store_dtype = np.dtype(dtype) if dtype is not None else np.dtype(source.dtype)
+    meta = {"shape": [int(v) for v in source.shape], "dtype": store_dtype.str, "codec": codec, "chunk_frames": chunk_frames}
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        with open(os.path.join(directory, "meta.json")) as f:
+            if json.load(f) == meta:
+                return LocalFrameStore(directory)
+    # write into a temporary directory, then move it into place
+    tmp_directory = f"{directory}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.makedirs(tmp_directory)
+    try:
+        _write_store(X, tmp_directory, meta, verbose=verbose)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+    return LocalFrameStore(directory)
+
+
+def _write_store(X, directory: str, meta: dict, *, verbose: bool):
+    compressor = _get_codec(meta["codec"])
+    chunk_frames = meta["chunk_frames"]
+    store_dtype = np.dtype(meta["dtype"])
+    num_frames = meta["shape"][0]
+    frame_bytes = max(1, int(np.prod(meta["shape"][1:])) * np.dtype(X.obj.data.dtype).itemsize)
+    # fetch whole chunks, in batches of about _fetch_batch_bytes
+    batch_frames = max(1, _fetch_batch_bytes // frame_bytes // chunk_frames) * chunk_frames
+    offsets = [0]
+    with open(os.path.join(directory, "data.bin"), "wb") as f:
+        for i1 in range(0, num_frames, batch_frames):
+            i2 = min(num_frames, i1 + batch_frames)
+            if verbose:
+                print(f"Caching frames {i1}-{i2} of {num_frames}")
+            frames = np.ascontiguousarray(_convert_frames(X.get_frames(i1, i2), store_dtype))
+            for j1 in range(0, i2 - i1, chunk_frames):
+                chunk = frames[j1:j1 + chunk_frames]
+                buf = compressor.encode(chunk) if compressor is not None else chunk.tobytes()
+                f.write(buf)
+                offsets.append(offsets[-1] + len(buf))
+    np.save(os.path.join(directory, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    # meta.json last, since its presence marks a complete store
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def _convert_frames(frames: np.ndarray, dtype: np.dtype):
+    if frames.dtype == dtype:
+        return frames
+    if frames.dtype.kind == "f":
+        frames = np.rint(frames)
+    info = np.iinfo(dtype)
+    if frames.size > 0 and (frames.min() < info.min or frames.max() > info.max):
+        raise ValueError(f"Frame values in [{frames.min()}, {frames.max()}] do not fit in {dtype} (use dtype=None to keep the source dtype)")
+    return frames.astype(dtype)
+
+
+def _get_codec(codec: str):
+    import numcodecs
+
+    if codec == "lz4":
+        return numcodecs.LZ4()
+    elif codec == "zstd":
+        return numcodecs.Zstd(level=3)
+    elif codec == "zlib":
+        return numcodecs.Zlib(level=4)
+    elif codec == "none":
+        return None
+    else:
+        raise ValueError(f"Unexpected codec: {codec}")
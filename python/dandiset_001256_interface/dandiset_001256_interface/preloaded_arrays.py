@@ -0,0 +1,86 @@
+import os
+from typing import List, Union
+import numpy as np
+from .cache_dir import get_cache_dir
+
+
+# Session arrays held in memory, so that repeated reads of the same series
+# (e.g. by successive code cells in a kernel) do not go back to the file. Each
+# preloaded array is also saved in the cache directory,
+#
+#   <cache dir>/preloaded/<asset id>/availability.json
+#   <cache dir>/preloaded/<asset id>/<kind>_<acquisition_name>.npy
+#
+# so that preloading again in a new process is a local read.
+
+preload_kinds = ["roi_responses", "pupil_radius"]
+
+
+def preload_session_arrays(S, *, kinds: List[str], acquisition_names: Union[List[str], None] = None, use_cache: bool = True):
+    for kind in kinds:
+        if kind not in preload_kinds:
+            raise ValueError(f"Unexpected kind: {kind}")
+    if acquisition_names is None:
+        acquisition_names = S.get_acquisition_names()
+    cache_dir = get_cache_dir("preloaded", S.get_cache_key()) if use_cache else None
+    entries = []
+    for a in acquisition_names:
+        for kind in kinds:
+            if not S.has_series(a, kind):
+                continue
+            x = S.get_preloaded_array(kind, a)
+            source = "memory"
+            if x is None:
+                X = S.get_roi_response_series(a) if kind == "roi_responses" else S.get_pupil_radius(a)
+                fname = os.path.join(cache_dir, f"{kind}_{a}.npy") if cache_dir is not None else None
+                x = _load_cached_array(fname, shape=tuple(X.obj.data.shape), dtype=np.dtype(X.obj.data.dtype))
+                source = "cache"
+                if x is None:
+                    x = np.ascontiguousarray(X.get_data())
+                    source = "nwb"
+                    if fname is not None:
+                        tmp_fname = fname + ".tmp.npy"
+                        np.save(tmp_fname, x)
+                        os.replace(tmp_fname, fname)
+                # readers get copies, so the preloaded array never changes
+                x.flags.writeable = False
+                S.set_preloaded_array(kind, a, x)
+            entries.append({
+                "acquisition_name": a,
+                "kind": kind,
+                "shape": tuple(x.shape),
+                "dtype": x.dtype.str,
+                "num_bytes": int(x.nbytes),
+                "source": source,
+            })
+    return entries
+
+
+def preload_session_availability(S, *, use_cache: bool = True):
+    # Fills in S.get_availability() from the cache directory if it is there,
+    # otherwise from the file, and makes sure it is saved for next time.
+    # Returns where it came from: "memory", "cache" or "nwb".
+    fname = os.path.join(get_cache_dir("preloaded", S.get_cache_key()), "availability.json") if use_cache else None
+    if S.has_availability():
+        # computed before the preload, and maybe never saved
+        if fname is not None and not os.path.exists(fname):
+            S.save_availability(fname)
+        return "memory"
+    if fname is not None and os.path.exists(fname) and S.load_availability(fname):
+        return "cache"
+    S.get_availability()
+    if fname is not None:
+        S.save_availability(fname)
+    return "nwb"
+
+
+def _load_cached_array(fname: Union[str, None], *, shape: tuple, dtype: np.dtype):
+    if fname is None or not os.path.exists(fname):
+        return None
+    try:
+        x = np.load(fname)
+    except (OSError, ValueError):
+        return None
+    if x.shape != shape or x.dtype != dtype:
+        return None
+    return x
@@ -0,0 +1,387 @@
+import base64
+import itertools
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, List, Tuple, Union
+import numpy as np
+from .remote_reader import RemoteReader, get_default_remote_reader
+
+if TYPE_CHECKING:
+    import lindi
+
+
+# Plans and executes reads of dataset selections directly from the chunk
+# references of a lindi reference file system. A selection is turned into the
+# set of chunks that intersect it, the byte ranges of those chunks are
+# coalesced into as few HTTP range requests as possible, and the requests are
+# run concurrently. Use plan() to inspect what a read would fetch.
+
+
+class ChunkRef:
+    def __init__(self, *, chunk_index: Tuple[int, ...], url: Union[str, None], offset: int, size: int, inline_data: Union[bytes, None]):
+        self.chunk_index = chunk_index
+        self.url = url
+        self.offset = offset
+        self.size = size
+        self.inline_data = inline_data
+
+
+class RangeRequest:
+    def __init__(self, *, url: str, start: int, end: int, chunks: List[ChunkRef]):
+        self.url = url
+        self.start = start
+        self.end = end  # exclusive
+        self.chunks = chunks
+
+    @property
+    def num_bytes(self):
+        return self.end - self.start
+
+    @property
+    def num_chunk_bytes(self):
+        # bytes of the request that belong to its chunks (the rest are gaps)
+        return sum(c.size for c in self.chunks)
+
+
+class ReadPlan:
+    def __init__(
+        self,
+        *,
+        dataset_path: str,
+        selection: List[Union[int, Tuple[int, int]]],
+        out_shape: Tuple[int, ...],
+        dtype: np.dtype,
+        chunk_shape: Tuple[int, ...],
+        compression: Union[List[str], None],
+        chunks: List[ChunkRef],
+        cached_chunks: List[ChunkRef],
+        missing_chunks: List[Tuple[int, ...]],
+        requests: List[RangeRequest]
+    ):
+        self.dataset_path = dataset_path
+        self.selection = selection
+        self.out_shape = out_shape
+        self.dtype = dtype
+        self.chunk_shape = chunk_shape
+        self.compression = compression
+        self.chunks = chunks  # chunks that need to be fetched or decoded from inline data
+        self.cached_chunks = cached_chunks  # chunks that are in the local cache
+        self.missing_chunks = missing_chunks  # chunks that are not stored (fill value)
+        self.requests = requests
+
+    @property
+    def num_chunks(self):
+        return len(self.chunks) + len(self.cached_chunks) + len(self.missing_chunks)
+
+    @property
+    def num_requests(self):
+        return len(self.requests)
+
+    @property
+    def num_bytes(self):
+        # bytes transferred, including any gaps between coalesced chunks
+        return sum(r.num_bytes for r in self.requests)
+
+    @property
+    def num_chunk_bytes(self):
+        return sum(r.num_chunk_bytes for r in self.requests)
+
+    @property
+    def num_returned_bytes(self):
+        return math.prod(self.out_shape) * self.dtype.itemsize
+
+    def summary(self):
+        return {
+            "dataset_path": self.dataset_path,
+            "out_shape": list(self.out_shape),
+            "chunk_shape": list(self.chunk_shape),
+            "compression": self.compression,
+            "num_chunks": self.num_chunks,
+            "num_cached_chunks": len(self.cached_chunks),
+            "num_missing_chunks": len(self.missing_chunks),
+            "num_requests": self.num_requests,
+            "num_bytes": self.num_bytes,
+            "num_chunk_bytes": self.num_chunk_bytes,
+            "num_returned_bytes": self.num_returned_bytes,
+        }
+
+
+class ReadPlanner:
+    def __init__(
+        self,
+        rfs: dict,
+        *,
+        local_cache: Union["lindi.LocalCache", None] = None,
+        max_gap_bytes: int = 32 * 1024,
+        max_request_bytes: int = 32 * 1024 * 1024,
+        max_overfetch_ratio: float = 2.0,
+        max_workers: int = 8,
+        remote_reader: Union[RemoteReader, None] = None
+    ):
+        self._refs = rfs["refs"]
+        self._templates = rfs.get("templates", {})
+        self.local_cache = local_cache
+        self.max_gap_bytes = max_gap_bytes
+        self.max_request_bytes = max_request_bytes
+        # a merged request may fetch at most this many times the bytes of its
+        # chunks, so that small reads are not merged across large gaps
+        self.max_overfetch_ratio = max_overfetch_ratio
+        self.max_workers = max_workers
+        self._zarray_cache = {}
+        # dataset paths with chunks that are not at http(s) urls (see has_dataset)
+        self._local_ref_paths = None
+        # timeouts, retries and hedging of the range requests (default: the
+        # shared reader from configure_remote_reads)
+        self._remote_reader = remote_reader
+
+    def has_dataset(self, dataset_path: str):
+        # Only datasets whose chunks are inline or at http(s) urls can be read
+        # here. Chunks stored in the file itself (e.g. ./blobs/... in a
+        # .lindi.tar) are left to the caller's dataset read.
+        path = _without_initial_slash(dataset_path)
+        if path + "/.zarray" not in self._refs:
+            return False
+        if self._local_ref_paths is None:
+            self._local_ref_paths = self._get_local_ref_paths()
+        return path not in self._local_ref_paths
+
+    def _get_local_ref_paths(self):
+        ret = set()
+        for key, ref in self._refs.items():
+            if not isinstance(ref, list):
+                continue
+            url = self._resolve_url(ref[0])
+            if not (url.startswith("http://") or url.startswith("https://")):
+                # the dataset is the nearest parent with a .zarray (chunk
+                # keys contain "/" when the dimension separator is "/")
+                parent = key.rpartition("/")[0]
+                while parent and parent + "/.zarray" not in self._refs:
+                    parent = parent.rpartition("/")[0]
+                ret.add(parent)
+        return ret
+
+    def _resolve_url(self, url: str):
+        if "{{" in url:
+            for k, v in self._templates.items():
+                url = url.replace("{{" + k + "}}", v)
+        return url
+
+    def plan(self, dataset_path: str, selection: Any) -> ReadPlan:
+        path = _without_initial_slash(dataset_path)
+        zarray = self._get_zarray(path)
+        shape = tuple(zarray["shape"])
+        chunk_shape = tuple(zarray["chunks"])
+        sel = _normalize_selection(selection, shape)
+        out_shape = tuple(s[1] - s[0] for s in sel if isinstance(s, tuple))
+        ranges_per_dim = []
+        for s, c in zip(sel, chunk_shape):
+            if isinstance(s, tuple):
+                if s[1] <= s[0]:
+                    ranges_per_dim.append(range(0))
+                else:
+                    ranges_per_dim.append(range(s[0] // c, (s[1] - 1) // c + 1))
+            else:
+                ranges_per_dim.append(range(s // c, s // c + 1))
+        sep = zarray.get("dimension_separator", ".")
+        chunks = []
+        cached_chunks = []
+        missing_chunks = []
+        for chunk_index in itertools.product(*ranges_per_dim):
+            key = path + "/" + (sep.join(str(i) for i in chunk_index) if len(chunk_index) > 0 else "0")
+            ref = self._refs.get(key)
+            if ref is None:
+                missing_chunks.append(chunk_index)
+            elif isinstance(ref, list):
+                url = self._resolve_url(ref[0])
+                if not (url.startswith("http://") or url.startswith("https://")):
+                    raise ValueError(f"Unsupported chunk reference: {url}")
+                cr = ChunkRef(chunk_index=chunk_index, url=url, offset=int(ref[1]), size=int(ref[2]), inline_data=None)
+                if self.local_cache is not None and self.local_cache.get_remote_chunk(url=cr.url, offset=cr.offset, size=cr.size) is not None:
+                    cached_chunks.append(cr)
+                else:
+                    chunks.append(cr)
+            else:
+                chunks.append(ChunkRef(chunk_index=chunk_index, url=None, offset=0, size=0, inline_data=_decode_inline(ref)))
+        compression = [c["id"] for c in _get_codec_configs(zarray)] or None
+        return ReadPlan(
+            dataset_path=path,
+            selection=sel,
+            out_shape=out_shape,
+            dtype=np.dtype(zarray["dtype"]),
+            chunk_shape=chunk_shape,
+            compression=compression,
+            chunks=chunks,
+            cached_chunks=cached_chunks,
+            missing_chunks=missing_chunks,
+            requests=self._coalesce([c for c in chunks if c.url is not None])
+        )
+
+    def read(self, dataset_path: str, selection: Any, *, out: Union[np.ndarray, None] = None):
+        return self.execute(self.plan(dataset_path, selection), out=out)
+
+    def execute(self, plan: ReadPlan, *, out: Union[np.ndarray, None] = None):
+        zarray = self._get_zarray(plan.dataset_path)
+        if out is None:
+            out = np.empty(plan.out_shape, dtype=plan.dtype)
+        elif out.shape != plan.out_shape:
+            raise ValueError(f"Unexpected shape for out: {out.shape} != {plan.out_shape}")
+        codecs = [_get_codec(c) for c in _get_codec_configs(zarray)]
+        fill_value = zarray.get("fill_value")
+
+        def place(chunk_index, chunk_data: Union[bytes, None]):
+            if chunk_data is None:
+                chunk = None
+            else:
+                chunk = _decode_chunk(chunk_data, codecs, plan.dtype, plan.chunk_shape, zarray.get("order", "C"), fill_value)
+            _copy_chunk_to_out(chunk, chunk_index, plan.chunk_shape, plan.selection, out, fill_value)
+
+        for chunk_index in plan.missing_chunks:
+            place(chunk_index, None)
+        for c in plan.chunks:
+            if c.inline_data is not None:
+                place(c.chunk_index, c.inline_data)
+        for c in plan.cached_chunks:
+            assert self.local_cache is not None
+            data = self.local_cache.get_remote_chunk(url=c.url, offset=c.offset, size=c.size)
+            if data is None:
+                # evicted since the plan was made
+                data = self._fetch(c.url, c.offset, c.offset + c.size)  # type: ignore
+            place(c.chunk_index, data)
+
+        def run_request(r: RangeRequest):
+            buf = self._fetch(r.url, r.start, r.end)
+            ret = []
+            for c in r.chunks:
+                data = buf[c.offset - r.start:c.offset - r.start + c.size]
+                if self.local_cache is not None:
+                    self.local_cache.put_remote_chunk(url=r.url, offset=c.offset, size=c.size, data=data)
+                ret.append((c.chunk_index, data))
+            return ret
+
+        if len(plan.requests) == 1:
+            results = [run_request(plan.requests[0])]
+        elif len(plan.requests) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(run_request, plan.requests))
+        else:
+            results = []
+        for rr in results:
+            for chunk_index, data in rr:
+                place(chunk_index, data)
+        return out
+
+    def _fetch(self, url: str, start: int, end: int) -> bytes:
+        reader = self._remote_reader if self._remote_reader is not None else get_default_remote_reader()
+        return reader.get_range(url, start, end)
+
+    def _coalesce(self, chunks: List[ChunkRef]) -> List[RangeRequest]:
+        ret: List[RangeRequest] = []
+        last_chunk_bytes = 0
+        for c in sorted(chunks, key=lambda c: (c.url, c.offset)):
+            assert c.url is not None
+            last = ret[-1] if ret else None
+            if (
+                last is not None and last.url == c.url
+                and c.offset - last.end <= self.max_gap_bytes
+                and max(last.end, c.offset + c.size) - last.start <= self.max_request_bytes
+                and max(last.end, c.offset + c.size) - last.start <= self.max_overfetch_ratio * (last_chunk_bytes + c.size)
+            ):
+                last.end = max(last.end, c.offset + c.size)
+                last.chunks.append(c)
+                last_chunk_bytes += c.size
+            else:
+                ret.append(RangeRequest(url=c.url, start=c.offset, end=c.offset + c.size, chunks=[c]))
+                last_chunk_bytes = c.size
+        return ret
+
+    def _get_zarray(self, path: str) -> dict:
+        if path not in self._zarray_cache:
+            x = self._refs.get(path + "/.zarray")
+            if x is None:
+                raise KeyError(f"Dataset not found: {path}")
+            if isinstance(x, str):
+                x = json.loads(_decode_inline(x))
+            self._zarray_cache[path] = x
+        return self._zarray_cache[path]
+
+
+def _without_initial_slash(path: str):
+    return path[1:] if path.startswith("/") else path
+
+
+def _decode_inline(x: str) -> bytes:
+    if x.startswith("base64:"):
+        return base64.b64decode(x[len("base64:"):])
+    return x.encode("utf-8")
+
+
+def _normalize_selection(selection: Any, shape: Tuple[int, ...]) -> List[Union[int, Tuple[int, int]]]:
+    if not isinstance(selection, tuple):
+        selection = (selection,)
+    if len(selection) > len(shape):
+        raise ValueError(f"Too many indices for dataset of shape {shape}")
+    selection = selection + (slice(None),) * (len(shape) - len(selection))
+    ret: List[Union[int, Tuple[int, int]]] = []
+    for s, n in zip(selection, shape):
+        if isinstance(s, slice):
+            start, stop, step = s.indices(n)
+            if step != 1:
+                raise ValueError("Only slices with step 1 are supported")
+            ret.append((start, max(start, stop)))
+        elif isinstance(s, (int, np.integer)):
+            i = int(s)
+            if i < 0:
+                i += n
+            if i < 0 or i >= n:
+                raise IndexError(f"Index {s} out of range for dimension of size {n}")
+            ret.append(i)
+        else:
+            raise ValueError(f"Unsupported selection: {s}")
+    return ret
+
+
+def _get_codec_configs(zarray: dict) -> list:
+    # in the order they were applied when encoding
+    ret = list(zarray.get("filters") or [])
+    if zarray.get("compressor") is not None:
+        ret.append(zarray["compressor"])
+    return ret
+
+
+def _get_codec(config: dict):
+    import numcodecs
+
+    return numcodecs.get_codec(dict(config))
+
+
+def _decode_chunk(data: bytes, codecs: list, dtype: np.dtype, chunk_shape: Tuple[int, ...], order: str, fill_value):
+    buf: Any = data
+    for codec in reversed(codecs):
+        buf = codec.decode(buf)
+    arr = np.frombuffer(buf, dtype=dtype)
+    n = math.prod(chunk_shape)
+    if arr.size < n:
+        # lindi allows chunks at the edge of the dataset to be stored truncated
+        arr2 = np.full(n, fill_value if fill_value is not None else 0, dtype=dtype)
+        arr2[:arr.size] = arr
+        arr = arr2
+    return arr[:n].reshape(chunk_shape, order=order)  # type: ignore
+
+
+def _copy_chunk_to_out(chunk: Union[np.ndarray, None], chunk_index: Tuple[int, ...], chunk_shape: Tuple[int, ...], selection: list, out: np.ndarray, fill_value):
+    src = []
+    dst = []
+    for s, i, c in zip(selection, chunk_index, chunk_shape):
+        chunk_start = i * c
+        if isinstance(s, tuple):
+            a = max(s[0], chunk_start)
+            b = min(s[1], chunk_start + c)
+            src.append(slice(a - chunk_start, b - chunk_start))
+            dst.append(slice(a - s[0], b - s[0]))
+        else:
+            src.append(s - chunk_start)
+    if chunk is None:
+        out[tuple(dst)] = fill_value if fill_value is not None else 0
+    else:
+        out[tuple(dst)] = chunk[tuple(src)]
@@ -0,0 +1,96 @@
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Tuple, Union
+import numpy as np
+from .Session import Session
+from .accumulators import BinnedStats
+from .get_dandiset_info import get_dandiset_info
+
+
+reduce_kinds = ["pupil_radius", "roi_responses"]
+
+# Samples are read in blocks of about this many values, so memory use does not
+# depend on the length of the recordings
+_block_size_values = 4 * 1024 * 1024
+
+
+def reduce_dandiset(
+    kind: str,
+    grid: np.ndarray,
+    *,
+    stats: Tuple[str, ...] = ("mean", "var", "count"),
+    sessions: Union[List[dict], None] = None,
+    roi: Union[int, None] = None,
+    max_workers: Union[int, None] = None,
+    ddof: int = 0,
+    verbose: bool = True
+):
+    # Per-time-bin statistics over every acquisition of every session.
+    #
+    # grid holds the bin edges in seconds, relative to the starting time of
+    # each acquisition (so acquisitions are aligned to their start). For
+    # roi_responses, every ROI trace of every acquisition contributes to the
+    # bins, unless roi (1-based ROI number) is given. Sessions are visited one
+    # at a time (or in max_workers worker processes), each producing a
+    # BinnedStats accumulator that is merged into the total, so memory use is
+    # independent of the number of sessions.
+    if kind not in reduce_kinds:
+        raise ValueError(f"Unexpected kind: {kind}")
+    grid = np.asarray(grid, dtype=np.float64)
+    if grid.ndim != 1 or len(grid) < 2 or np.any(np.diff(grid) <= 0):
+        raise ValueError("grid must be an increasing 1D array of bin edges")
+    if sessions is None:
+        sessions = get_dandiset_info()["sessions"]
+    nwb_urls = [s["asset_url"] for s in sessions]
+    total = BinnedStats(len(grid) - 1)
+    if max_workers is None or max_workers <= 1:
+        for i, nwb_url in enumerate(nwb_urls):
+            if verbose:
+                print(f"Reducing session {i + 1} of {len(nwb_urls)}")
+            total.merge(reduce_session(nwb_url, kind, grid, roi=roi))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(reduce_session, nwb_url, kind, grid, roi=roi) for nwb_url in nwb_urls]
+            for i, future in enumerate(as_completed(futures)):
+                if verbose:
+                    print(f"Reduced {i + 1} of {len(nwb_urls)} sessions")
+                total.merge(future.result())
+    return {"bin_edges": grid, **total.get_stats(stats, ddof=ddof)}
+
+
+def reduce_session(nwb_url: str, kind: str, grid: np.ndarray, *, roi: Union[int, None] = None):
+    # Not using load_session, so that the session is released when done
+    S = Session(nwb_url=nwb_url, backend="raw")
+    acc = BinnedStats(len(grid) - 1)
+    for acquisition_name in S.get_acquisition_names():
+        if kind == "pupil_radius":
+            if not S.has_pupil_radius(acquisition_name):
+                continue
+            X = S.get_pupil_radius(acquisition_name)
+            num_channels = 1
+        elif kind == "roi_responses":
+            if not S.has_roi_response_series(acquisition_name):
+                continue
+            X = S.get_roi_response_series(acquisition_name)
+            num_channels = 1 if roi is not None else X.num_channels
+        else:
+            raise ValueError(f"Unexpected kind: {kind}")
+        # only the rows with grid[0] <= t < grid[-1] are read (with a one
+        # sample margin for rounding; the extra samples fall outside the grid)
+        j1 = min(X.num_samples, max(0, math.ceil(grid[0] * X.rate) - 1))
+        j2 = min(X.num_samples, max(j1, math.floor(grid[-1] * X.rate) + 2))
+        block_size = max(1, _block_size_values // num_channels)
+        for i1 in range(j1, j2, block_size):
+            i2 = min(j2, i1 + block_size)
+            if kind == "roi_responses" and roi is not None:
+                values = X.get_channel_data(roi - 1, i1, i2)
+            else:
+                values = X.get_data(i1, i2)
+            t = np.arange(i1, i2) / X.rate
+            # samples outside the grid get bin index -1 or num_bins, and are ignored
+            bin_indices = np.searchsorted(grid, t, side="right") - 1
+            if values.ndim == 2:
+                bin_indices = np.repeat(bin_indices[:, None], values.shape[1], axis=1)
+            acc.add(bin_indices, values)
+    return acc
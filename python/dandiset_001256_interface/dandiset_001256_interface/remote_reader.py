@@ -0,0 +1,320 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Union
+import numpy as np
+
+
+# HTTP reads with connect/read timeouts, bounded retries with exponential
+# backoff (full jitter), and hedging of range reads: once enough latencies
+# have been seen for reads of about the same size, an attempt that is still
+# running after the hedge_percentile latency of that size gets a duplicate
+# request, and whichever response arrives first is used. This keeps an
+# occasional straggler from stalling a whole batch of range requests. At most
+# hedge_budget of the recent requests are hedged, so a slow period can not
+# double the traffic. Requests that are not range reads are never hedged.
+# The hedge delay counts from when the attempt starts (not from when it is
+# queued), hedges run on their own small pool so they do not queue behind the
+# attempts they are hedging, and the losing attempt is cancelled (or its
+# response closed) once the other one has succeeded.
+#
+# The read planner and the lindi file lookup go through the default reader,
+# which can be replaced with configure_remote_reads(...).
+class RemoteReader:
+    def __init__(
+        self,
+        *,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        num_retries: int = 4,
+        backoff_base: float = 0.25,
+        backoff_max: float = 8,
+        hedge_percentile: Union[float, None] = 95,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.05,
+        hedge_budget: float = 0.1,
+        max_workers: int = 32,
+        stats_window: int = 1000
+    ):
+        # hedge_percentile=None disables hedging
+        import requests
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.num_retries = num_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_budget = hedge_budget
+        self._stats_window = stats_window
+        self._http_session = requests.Session()
+        num_hedge_workers = max(1, max_workers // 4)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=max_workers + num_hedge_workers)
+        self._http_session.mount("http://", adapter)
+        self._http_session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=num_hedge_workers)
+        self._lock = threading.Lock()
+        # latencies (seconds) of single successful range read attempts, per
+        # size bucket (see _get_size_bucket), for the hedge thresholds
+        self._attempt_latencies: Dict[int, deque] = {}
+        # 1 for each recent request that was hedged, 0 otherwise
+        self._recent_hedged = deque(maxlen=stats_window)
+        self._hedges_in_flight = 0
+        # latencies (seconds) of whole requests, including retries and hedges
+        self._request_latencies = deque(maxlen=stats_window)
+        self._counts = {"requests": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0}
+
+    def get_range(self, url: str, start: int, end: int) -> bytes:
+        resp = self.request("GET", url, headers={"Range": f"bytes={start}-{end - 1}"}, num_bytes=end - start)
+        if resp.status_code != 206 and len(resp.content) != end - start:
+            raise Exception(f"Server did not honor range request for {url}")
+        return resp.content
+
+    def head(self, url: str, *, allow_redirects: bool = False):
+        # Like requests.head, redirects are not followed by default (for DANDI
+        # asset urls that would be a round trip to S3)
+        return self.request("HEAD", url, hedge=False, raise_for_status=False, allow_redirects=allow_redirects)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        headers: Union[dict, None] = None,
+        hedge: bool = True,
+        raise_for_status: bool = True,
+        allow_redirects: bool = True,
+        num_bytes: Union[int, None] = None
+    ):
+        # num_bytes is the size of a range read. Only range reads are hedged
+        # and contribute to the hedge thresholds.
+        if num_bytes is None:
+            hedge = False
+        t0 = time.perf_counter()
+        with self._lock:
+            self._counts["requests"] += 1
+        attempt = 0
+        while True:
+            try:
+                resp = self._hedged_attempt(method, url, headers, hedge=hedge, allow_redirects=allow_redirects, num_bytes=num_bytes)
+            except Exception as e:
+                if attempt >= self.num_retries or not _is_retryable_error(e):
+                    with self._lock:
+                        self._counts["failures"] += 1
+                    raise
+            else:
+                if attempt >= self.num_retries or not _is_retryable_status(resp.status_code):
+                    with self._lock:
+                        self._request_latencies.append(time.perf_counter() - t0)
+                        if not resp.ok:
+                            self._counts["failures"] += 1
+                    if raise_for_status:
+                        resp.raise_for_status()
+                    return resp
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            with self._lock:
+                self._counts["retries"] += 1
+            time.sleep(delay)
+            attempt += 1
+
+    def _hedged_attempt(self, method: str, url: str, headers: Union[dict, None], *, hedge: bool, allow_redirects: bool, num_bytes: Union[int, None]):
+        threshold = self.get_hedge_threshold(num_bytes) if hedge and num_bytes is not None else None
+        primary_state = _AttemptState()
+        primary = self._executor.submit(self._attempt, primary_state, method, url, headers, allow_redirects, num_bytes)
+        if threshold is None:
+            if num_bytes is not None:
+                self._record_hedged(False)
+            return primary.result()
+        # the hedge delay counts from when the attempt starts, not from when
+        # it was queued
+        while not primary_state.started.wait(timeout=0.1):
+            if primary.done():
+                break
+        remaining = threshold - (time.perf_counter() - primary_state.t0) if primary_state.started.is_set() else 0
+        done, _ = wait([primary], timeout=max(0, remaining))
+        if done or not self._take_hedge():
+            self._record_hedged(False)
+            return primary.result()
+        try:
+            secondary_state = _AttemptState()
+            secondary = self._hedge_executor.submit(self._attempt, secondary_state, method, url, headers, allow_redirects, num_bytes)
+            states = {primary: primary_state, secondary: secondary_state}
+            pending = {primary, secondary}
+            error = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    if f.exception() is None:
+                        if f is secondary:
+                            with self._lock:
+                                self._counts["hedge_wins"] += 1
+                        for g in pending:
+                            if not g.cancel():
+                                states[g].cancel()
+                        return f.result()
+                    error = f.exception()
+            assert error is not None
+            raise error
+        finally:
+            with self._lock:
+                self._hedges_in_flight -= 1
+                self._recent_hedged.append(1)
+
+    def _take_hedge(self):
+        # Whether a hedge fits in the budget (and if so, counts it)
+        with self._lock:
+            num_hedged = sum(self._recent_hedged) + self._hedges_in_flight
+            if num_hedged + 1 > self.hedge_budget * max(len(self._recent_hedged), self.hedge_min_samples):
+                return False
+            self._hedges_in_flight += 1
+            self._counts["hedges"] += 1
+            return True
+
+    def _record_hedged(self, hedged: bool):
+        with self._lock:
+            self._recent_hedged.append(1 if hedged else 0)
+
+    def _attempt(self, state: "_AttemptState", method: str, url: str, headers: Union[dict, None], allow_redirects: bool, num_bytes: Union[int, None]):
+        with self._lock:
+            self._counts["attempts"] += 1
+        t0 = time.perf_counter()
+        state.t0 = t0
+        state.started.set()
+        resp = self._http_session.request(method, url, headers=headers, timeout=(self.connect_timeout, self.read_timeout), allow_redirects=allow_redirects, stream=True)
+        state.set_response(resp)
+        # read the body here, so that the latency includes the transfer
+        try:
+            resp.content
+        except Exception:
+            if state.cancelled:
+                raise _AttemptCancelled()
+            raise
+        if state.cancelled:
+            raise _AttemptCancelled()
+        if resp.ok and num_bytes is not None:
+            bucket = _get_size_bucket(num_bytes)
+            with self._lock:
+                if bucket not in self._attempt_latencies:
+                    self._attempt_latencies[bucket] = deque(maxlen=self._stats_window)
+                self._attempt_latencies[bucket].append(time.perf_counter() - t0)
+        return resp
+
+    def get_hedge_threshold(self, num_bytes: int):
+        # seconds before an attempt to read num_bytes gets a hedge (None if
+        # hedging is disabled or there are not yet enough latencies for reads
+        # of about that size)
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            latencies = self._attempt_latencies.get(_get_size_bucket(num_bytes))
+            if latencies is None or len(latencies) < self.hedge_min_samples:
+                return None
+            latencies = np.array(latencies)
+        return max(self.hedge_min_delay, float(np.percentile(latencies, self.hedge_percentile)))
+
+    def get_stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            latencies = np.array(self._request_latencies)
+            buckets = sorted(self._attempt_latencies)
+        # hedge thresholds by the upper end of the size bucket (bytes)
+        thresholds = {_get_size_bucket_max_bytes(b): self.get_hedge_threshold(_get_size_bucket_max_bytes(b)) for b in buckets}
+        ret = {**counts, "hedge_thresholds": thresholds}
+        for p in [50, 90, 95, 99]:
+            ret[f"latency_p{p}"] = float(np.percentile(latencies, p)) if len(latencies) else None
+        ret["latency_max"] = float(latencies.max()) if len(latencies) else None
+        return ret
+
+    def reset_stats(self):
+        with self._lock:
+            self._attempt_latencies.clear()
+            self._request_latencies.clear()
+            for k in self._counts:
+                self._counts[k] = 0
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._hedge_executor.shutdown(wait=False)
+        self._http_session.close()
+
+
+class _AttemptCancelled(Exception):
+    pass
+
+
+class _AttemptState:
+    # Shared between an attempt and the request waiting on it: when the
+    # attempt started, and its response, so that the losing attempt of a
+    # hedged pair can be stopped
+    def __init__(self):
+        self.started = threading.Event()
+        self.t0 = None
+        self.cancelled = False
+        self._resp = None
+        self._lock = threading.Lock()
+
+    def set_response(self, resp):
+        with self._lock:
+            self._resp = resp
+            cancelled = self.cancelled
+        if cancelled:
+            resp.close()
+            raise _AttemptCancelled()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            resp = self._resp
+        if resp is not None:
+            resp.close()
+
+
+# Range reads are grouped by size into power-of-two buckets, starting at 4 KB
+def _get_size_bucket(num_bytes: int):
+    return max(0, (max(1, num_bytes) - 1).bit_length() - 12)
+
+
+def _get_size_bucket_max_bytes(bucket: int):
+    return 4096 << bucket
+
+
+def _is_retryable_status(status_code: int):
+    return status_code in (408, 429) or status_code >= 500
+
+
+def _is_retryable_error(e: Exception):
+    import requests
+
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and _is_retryable_status(e.response.status_code)
+    return False
+
+
+_default_remote_reader: Union[RemoteReader, None] = None
+_default_remote_reader_lock = threading.Lock()
+
+
+def get_default_remote_reader():
+    global _default_remote_reader
+    with _default_remote_reader_lock:
+        if _default_remote_reader is None:
+            _default_remote_reader = RemoteReader()
+        return _default_remote_reader
+
+
+def configure_remote_reads(**kwargs):
+    # Replaces the default reader, e.g. configure_remote_reads(read_timeout=10, hedge_percentile=None)
+    global _default_remote_reader
+    with _default_remote_reader_lock:
+        old = _default_remote_reader
+        _default_remote_reader = RemoteReader(**kwargs)
+    if old is not None:
+        old.close()
+    return _default_remote_reader
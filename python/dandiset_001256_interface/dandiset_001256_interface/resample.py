@@ -0,0 +1,66 @@
+import numpy as np
+
+
+resample_methods = ["linear", "nearest", "decimate"]
+
+
+def get_source_row_range(t: np.ndarray, *, rate: float, starting_time: float, num_samples: int, method: str, target_rate: float):
+    # The rows [i1, i2) of a uniformly sampled series that resample_uniform
+    # needs in order to produce values at the times t (sorted)
+    if len(t) == 0:
+        return 0, 0
+    pad = 1
+    if method == "decimate":
+        pad += _get_lowpass_half_length(rate, target_rate)
+    i1 = int(np.floor((t[0] - starting_time) * rate)) - pad
+    i2 = int(np.ceil((t[-1] - starting_time) * rate)) + 1 + pad
+    return max(0, i1), min(num_samples, i2)
+
+
+def resample_uniform(data: np.ndarray, t: np.ndarray, *, rate: float, starting_time: float, method: str, target_rate: float):
+    # Values of the uniformly sampled data (shape (num_samples, ...), with
+    # sample i at starting_time + i / rate) at the times t, for all columns in
+    # one pass. Times outside the series are clamped to the first/last sample.
+    if method not in resample_methods:
+        raise ValueError(f"Unexpected resampling method: {method}")
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[0]
+    if n == 0:
+        raise ValueError("Cannot resample an empty series")
+    if method == "decimate" and target_rate < rate:
+        data = lowpass(data, cutoff=target_rate / 2, rate=rate)
+    s = np.clip((t - starting_time) * rate, 0, n - 1)
+    if method == "nearest":
+        return data[np.rint(s).astype(np.int64)]
+    i0 = np.minimum(np.floor(s).astype(np.int64), n - 1)
+    i1 = np.minimum(i0 + 1, n - 1)
+    frac = (s - i0).reshape((-1,) + (1,) * (data.ndim - 1))
+    return data[i0] * (1 - frac) + data[i1] * frac
+
+
+def lowpass(data: np.ndarray, *, cutoff: float, rate: float):
+    # Zero-phase windowed-sinc (Hamming) FIR filter along axis 0, applied by
+    # FFT to all columns at once. The ends are extended by reflection so that
+    # the filter does not pull the edges toward zero.
+    half_length = _get_lowpass_half_length(rate, 2 * cutoff)
+    n = data.shape[0]
+    if n < 2 or half_length == 0:
+        return data
+    k = np.arange(-half_length, half_length + 1)
+    h = 2 * cutoff / rate * np.sinc(2 * cutoff / rate * k) * np.hamming(len(k))
+    h /= h.sum()
+    pad = min(half_length, n - 1)
+    x = np.concatenate([data[pad:0:-1], data, data[-2:-pad - 2:-1]], axis=0)
+    m = x.shape[0] + len(h) - 1
+    nfft = 1 << int(m - 1).bit_length()
+    H = np.fft.rfft(h, nfft).reshape((-1,) + (1,) * (data.ndim - 1))
+    y = np.fft.irfft(np.fft.rfft(x, nfft, axis=0) * H, nfft, axis=0)
+    # full convolution output j corresponds to input j - half_length
+    return y[half_length + pad:half_length + pad + n]
+
+
+def _get_lowpass_half_length(rate: float, target_rate: float):
+    if target_rate >= rate:
+        return 0
+    # about four periods of the new sampling interval on each side
+    return int(np.ceil(4 * rate / target_rate))
@@ -0,0 +1,424 @@
+import gzip
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Union
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from .Session import load_session
+from .get_dandiset_info import get_dandiset_info
+
+if TYPE_CHECKING:
+    import lindi
+
+
+# Endpoints (all GET):
+#
+#   /sessions
+#       JSON list of the sessions in the dandiset
+#   /sessions/<session_id>/acquisitions
+#       JSON list of the acquisitions in the session, with the availability,
+#       shapes, rates and starting times of their series
+#   /sessions/<session_id>/acquisitions/<acquisition_name>/<kind>.npy
+#   /sessions/<session_id>/acquisitions/<acquisition_name>/<kind>.bin
+#       Array payload, either as a .npy file or as raw little-endian bytes
+#       (with the dtype and shape given in the X-Dtype and X-Shape headers)
+#
+# where <kind> is one of
+#
+#   roi_responses           (num_samples, num_rois), or (num_samples,) with ?roi=<roi_number>
+#   pupil_radius            (num_samples,)
+#   two_photon_frames       (num_frames, height, width) for ?start=<i>&end=<j>
+#   pupil_video_frames      (num_frames, height, width) for ?start=<i>&end=<j>
+#   roi_responses_envelope  (num_bins, 2, num_rois) min/max per bin for ?bins=<n>
+#   pupil_radius_envelope   (num_bins, 2) min/max per bin for ?bins=<n>
+#
+# roi_responses and pupil_radius also accept ?start=<i>&end=<j> sample ranges.
+#
+# HEAD requests for array payloads are answered from the session metadata
+# (and the payload cache), without computing the array.
+
+# The query parameters of each kind, in the order they go into the etag (any
+# other parameters are ignored)
+_query_params = {
+    "roi_responses": ["start", "end", "roi"],
+    "pupil_radius": ["start", "end"],
+    "two_photon_frames": ["start", "end"],
+    "pupil_video_frames": ["start", "end"],
+    "roi_responses_envelope": ["bins"],
+    "pupil_radius_envelope": ["bins"],
+}
+_array_kinds = list(_query_params)
+
+# The availability entry (see Session.get_availability) of the series that
+# each kind is computed from
+_series_of_kind = {
+    "roi_responses": "roi_responses",
+    "pupil_radius": "pupil_radius",
+    "two_photon_frames": "two_photon",
+    "pupil_video_frames": "pupil_video",
+    "roi_responses_envelope": "roi_responses",
+    "pupil_radius_envelope": "pupil_radius",
+}
+
+_max_frames_per_request = 1000
+_max_envelope_bins = 100_000
+
+
+# Unknown sessions, acquisitions, series and paths (404)
+class NotFound(Exception):
+    pass
+
+
+class DataService:
+    def __init__(self, *, local_cache: Union["lindi.LocalCache", None] = None, max_cache_bytes: int = 512 * 1024 * 1024):
+        self.local_cache = local_cache
+        self.max_cache_bytes = max_cache_bytes
+        self._sessions_by_id = None
+        # encoded payloads by (etag, format, content encoding)
+        self._payload_cache: OrderedDict = OrderedDict()
+        self._payload_cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        # h5py-style datasets are not safe for concurrent reads, so each
+        # session has a lock that is held while it is opened or read, and
+        # different sessions are served in parallel. _sessions_lock is only
+        # held for lookups and inserts in the two dicts.
+        self._sessions = {}
+        self._session_locks = {}
+        self._sessions_lock = threading.Lock()
+
+    def get_sessions(self):
+        if self._sessions_by_id is None:
+            info = get_dandiset_info()
+            self._sessions_by_id = {s["session_id"]: s for s in info["sessions"]}
+        return list(self._sessions_by_id.values())
+
+    def get_session(self, session_id: str):
+        self.get_sessions()
+        assert self._sessions_by_id is not None
+        if session_id not in self._sessions_by_id:
+            raise NotFound(f"Session not found: {session_id}")
+        with self._sessions_lock:
+            S = self._sessions.get(session_id)
+        if S is not None:
+            return S
+        with self._get_session_lock(session_id):
+            with self._sessions_lock:
+                S = self._sessions.get(session_id)
+            if S is None:
+                S = load_session(nwb_url=self._sessions_by_id[session_id]["asset_url"], local_cache=self.local_cache, backend="raw")
+                with self._sessions_lock:
+                    self._sessions[session_id] = S
+        return S
+
+    def _get_session_lock(self, session_id: str):
+        with self._sessions_lock:
+            lock = self._session_locks.get(session_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._session_locks[session_id] = lock
+            return lock
+
+    def get_acquisitions(self, session_id: str):
+        S = self.get_session(session_id)
+        with self._get_session_lock(session_id):
+            availability = S.get_availability()
+        return [{"acquisition_name": name, **availability[name]} for name in S.get_acquisition_names()]
+
+    def get_etag(self, session_id: str, acquisition_name: str, kind: str, query: dict):
+        self.get_sessions()
+        assert self._sessions_by_id is not None
+        if session_id not in self._sessions_by_id:
+            raise NotFound(f"Session not found: {session_id}")
+        # The assets are immutable, so the etag only depends on the request
+        key = json.dumps([self._sessions_by_id[session_id]["asset_id"], acquisition_name, kind, list(_normalize_query(kind, query).items())])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def check_array(self, session_id: str, acquisition_name: str, kind: str):
+        # Raises NotFound unless the acquisition has the series of the kind.
+        # This only looks at the session metadata.
+        S = self.get_session(session_id)
+        with self._get_session_lock(session_id):
+            availability = S.get_availability()
+        if acquisition_name not in availability:
+            raise NotFound(f"Acquisition not found: {acquisition_name}")
+        if availability[acquisition_name][_series_of_kind[kind]] is None:
+            raise NotFound(f"No {_series_of_kind[kind]} series in acquisition {acquisition_name}")
+
+    def get_cached_payload(self, session_id: str, acquisition_name: str, kind: str, query: dict, fmt: str, *, gzipped: bool = False):
+        # The payload of get_payload if it is cached, otherwise None
+        cache_key = (self.get_etag(session_id, acquisition_name, kind, query), fmt, "gzip" if gzipped else "identity")
+        with self._cache_lock:
+            if cache_key in self._payload_cache:
+                self._payload_cache.move_to_end(cache_key)
+                return self._payload_cache[cache_key]
+        return None
+
+    def get_payload(self, session_id: str, acquisition_name: str, kind: str, query: dict, fmt: str, *, gzipped: bool = False):
+        # The encoded array, as a dict with the etag, data (bytes), dtype and
+        # shape. Payloads are cached, so repeated requests are not encoded
+        # (or compressed) again.
+        payload = self.get_cached_payload(session_id, acquisition_name, kind, query, fmt, gzipped=gzipped)
+        if payload is not None:
+            return payload
+        etag = self.get_etag(session_id, acquisition_name, kind, query)
+        cache_key = (etag, fmt, "gzip" if gzipped else "identity")
+        if gzipped:
+            p = self.get_payload(session_id, acquisition_name, kind, query, fmt)
+            payload = {**p, "data": gzip.compress(p["data"], compresslevel=1)}
+        else:
+            self.check_array(session_id, acquisition_name, kind)
+            S = self.get_session(session_id)
+            with self._get_session_lock(session_id):
+                x = _compute_array(S, acquisition_name, kind, _normalize_query(kind, query))
+            payload = {
+                "etag": etag,
+                "data": _encode_array(x, fmt),
+                "dtype": x.dtype.newbyteorder("<").str,
+                "shape": tuple(x.shape),
+            }
+        with self._cache_lock:
+            if cache_key not in self._payload_cache:
+                self._payload_cache[cache_key] = payload
+                self._payload_cache_bytes += len(payload["data"])
+            while self._payload_cache_bytes > self.max_cache_bytes and len(self._payload_cache) > 1:
+                _, p = self._payload_cache.popitem(last=False)
+                self._payload_cache_bytes -= len(p["data"])
+        return payload
+
+
+def _normalize_query(kind: str, query: dict):
+    # Only the parameters of the kind, as ints and in a fixed order, so that
+    # equivalent requests share an etag and a cache entry
+    if kind not in _query_params:
+        raise NotFound(f"Unexpected kind: {kind}")
+    ret = {}
+    for k in _query_params[kind]:
+        if k in query:
+            try:
+                ret[k] = int(query[k])
+            except ValueError:
+                raise ValueError(f"Invalid {k}: {query[k]}")
+    return ret
+
+
+def _compute_array(S, acquisition_name: str, kind: str, query: dict) -> np.ndarray:
+    if kind == "roi_responses":
+        X = S.get_roi_response_series(acquisition_name)
+        i1, i2 = _get_range(query, X.num_samples)
+        if "roi" in query:
+            roi_number = query["roi"]
+            if roi_number < 1 or roi_number > X.num_channels:
+                raise ValueError(f"Invalid roi: {roi_number}")
+            return X.get_channel_data(roi_number - 1, i1, i2)
+        return X.get_data(i1, i2)
+    elif kind == "pupil_radius":
+        X = S.get_pupil_radius(acquisition_name)
+        i1, i2 = _get_range(query, X.num_samples)
+        return X.get_data(i1, i2)
+    elif kind in ["two_photon_frames", "pupil_video_frames"]:
+        if kind == "two_photon_frames":
+            X = S.get_two_photon_series(acquisition_name)
+        else:
+            X = S.get_pupil_video(acquisition_name)
+        i1, i2 = _get_range(query, X.num_frames)
+        if i2 - i1 > _max_frames_per_request:
+            raise ValueError(f"Too many frames requested: {i2 - i1} > {_max_frames_per_request}")
+        return X.get_frames(i1, i2)
+    elif kind in ["roi_responses_envelope", "pupil_radius_envelope"]:
+        if kind == "roi_responses_envelope":
+            X = S.get_roi_response_series(acquisition_name)
+        else:
+            X = S.get_pupil_radius(acquisition_name)
+        num_bins = query.get("bins", 1000)
+        if num_bins < 1 or num_bins > _max_envelope_bins:
+            raise ValueError(f"Invalid number of bins: {num_bins}")
+        return _compute_envelope(X.get_data(), num_bins)
+    else:
+        raise ValueError(f"Unexpected kind: {kind}")
+
+
+def _get_range(query: dict, n: int):
+    i1 = query.get("start", 0)
+    i2 = query.get("end", n)
+    i1 = max(0, min(i1, n))
+    i2 = max(i1, min(i2, n))
+    return i1, i2
+
+
+def _compute_envelope(data: np.ndarray, num_bins: int):
+    # min/max of the data within each of num_bins equal-length bins
+    n = data.shape[0]
+    if n == 0:
+        return np.zeros((0, 2) + data.shape[1:], dtype=data.dtype)
+    num_bins = min(num_bins, n)
+    edges = np.linspace(0, n, num_bins + 1).astype(np.int64)
+    ret = np.empty((num_bins, 2) + data.shape[1:], dtype=data.dtype)
+    ret[:, 0] = np.minimum.reduceat(data, edges[:-1], axis=0)
+    ret[:, 1] = np.maximum.reduceat(data, edges[:-1], axis=0)
+    return ret
+
+
+def _encode_array(x: np.ndarray, fmt: str) -> bytes:
+    if fmt == "npy":
+        buf = io.BytesIO()
+        np.save(buf, x, allow_pickle=False)
+        return buf.getvalue()
+    elif fmt == "bin":
+        return x.astype(x.dtype.newbyteorder("<"), copy=False).tobytes()
+    else:
+        raise ValueError(f"Unexpected format: {fmt}")
+
+
+def _parse_range_header(range_header: str, size: int):
+    # Only single byte ranges are supported: bytes=a-b, bytes=a-, bytes=-n
+    if not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    a, _, b = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if a == "":
+            n = int(b)
+            if n <= 0:
+                return None
+            return max(0, size - n), size - 1
+        start = int(a)
+        end = int(b) if b != "" else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    service: DataService
+
+    def do_GET(self):
+        try:
+            self._handle_get()
+        except NotFound as e:
+            self._send_error(404, str(e))
+        except ValueError as e:
+            self._send_error(400, str(e))
+        except Exception as e:
+            self._send_error(500, str(e))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def _handle_get(self):
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        parts = [p for p in parsed.path.split("/") if p]
+        if parts == ["sessions"]:
+            self._send_json(self.service.get_sessions())
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "acquisitions":
+            self._send_json(self.service.get_acquisitions(parts[1]))
+        elif len(parts) == 5 and parts[0] == "sessions" and parts[2] == "acquisitions":
+            kind, _, fmt = parts[4].rpartition(".")
+            if kind not in _array_kinds or fmt not in ["npy", "bin"]:
+                raise NotFound(f"Not found: {parsed.path}")
+            self._send_array(parts[1], parts[3], kind, fmt, query)
+        else:
+            raise NotFound(f"Not found: {parsed.path}")
+
+    def _send_array(self, session_id: str, acquisition_name: str, kind: str, fmt: str, query: dict):
+        etag = '"' + self.service.get_etag(session_id, acquisition_name, kind, query) + "-" + fmt + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self._send_common_headers()
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        range_header = self.headers.get("Range")
+        gzipped = range_header is None and "gzip" in self.headers.get("Accept-Encoding", "")
+        if self.command == "HEAD":
+            p = self.service.get_cached_payload(session_id, acquisition_name, kind, query, fmt, gzipped=gzipped)
+            if p is None:
+                # answer from the metadata without computing the array (so
+                # without the length, dtype and shape)
+                self.service.check_array(session_id, acquisition_name, kind)
+                self.send_response(200)
+                self._send_common_headers()
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("ETag", etag)
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                return
+        else:
+            p = self.service.get_payload(session_id, acquisition_name, kind, query, fmt, gzipped=gzipped)
+        payload = p["data"]
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "X-Dtype": p["dtype"],
+            "X-Shape": ",".join(str(v) for v in p["shape"]),
+        }
+        if range_header is not None:
+            r = _parse_range_header(range_header, len(payload))
+            if r is None:
+                self.send_response(416)
+                self._send_common_headers()
+                self.send_header("Content-Range", f"bytes */{len(payload)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = r
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(payload)}"
+            self._send_payload(206, payload[start:end + 1], headers)
+            return
+        if gzipped:
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+        self._send_payload(200, payload, headers)
+
+    def _send_json(self, obj):
+        payload = json.dumps(obj).encode("utf-8")
+        self._send_payload(200, payload, {"Content-Type": "application/json"})
+
+    def _send_error(self, status: int, message: str):
+        payload = json.dumps({"error": message}).encode("utf-8")
+        self._send_payload(status, payload, {"Content-Type": "application/json"})
+
+    def _send_payload(self, status: int, payload: bytes, headers: dict):
+        self.send_response(status)
+        self._send_common_headers()
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def _send_common_headers(self):
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Expose-Headers", "ETag, Content-Range, Content-Length, X-Dtype, X-Shape")
+
+
+def serve(*, host: str = "127.0.0.1", port: int = 8001, local_cache_dir: Union[str, None] = None, max_cache_bytes: int = 512 * 1024 * 1024):
+    import lindi
+
+    local_cache = lindi.LocalCache(cache_dir=local_cache_dir)
+    service = DataService(local_cache=local_cache, max_cache_bytes=max_cache_bytes)
+    handler = type("RequestHandler", (_RequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving dandiset 001256 on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve dandiset 001256 session data over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--local-cache-dir", default=None, help="Directory for the lindi chunk cache (default: ~/.lindi/cache)")
+    args = parser.parse_args()
+    serve(host=args.host, port=args.port, local_cache_dir=args.local_cache_dir)
@@ -0,0 +1,150 @@
+import sys
+import weakref
+from multiprocessing import shared_memory
+from typing import Dict, List, Union
+import numpy as np
+
+
+# Session arrays published in shared memory, so that the worker processes of
+# a pool can all use one copy. The publishing process owns the shared memory
+# blocks (SharedSessionArrays) and frees them on close(); the workers receive
+# the small picklable handles and attach to them as read-only numpy views:
+#
+#   with S.publish_shared(kinds=["roi_responses"]) as published:
+#       with ProcessPoolExecutor() as executor:
+#           executor.map(work, [published.handles] * n)
+#
+#   def work(handles):
+#       arrays = attach_shared(handles)
+#       X = arrays["000"]["roi_responses"]
+#
+# Workers are expected to be started with multiprocessing (or
+# concurrent.futures), so they share the publisher's resource tracker and
+# attaching does not take ownership of the blocks.
+
+shared_kinds = ["roi_responses", "pupil_radius", "two_photon", "motion_corrected_two_photon", "pupil_video"]
+
+
+class SharedArrayHandle:
+    def __init__(self, *, name: str, shape: tuple, dtype: str, rate: float, starting_time: float):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.rate = rate
+        self.starting_time = starting_time
+
+    def attach(self):
+        shm = _attached.get(self.name)
+        if shm is None:
+            shm = _open_shared_memory(self.name)
+            _attached[self.name] = shm
+        x = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=shm.buf)
+        x.flags.writeable = False
+        return x
+
+    def __repr__(self):
+        return f"SharedArrayHandle(name={self.name!r}, shape={self.shape}, dtype={self.dtype!r})"
+
+
+class SharedSessionArrays:
+    def __init__(self):
+        # handles[acquisition_name][kind]
+        self.handles: Dict[str, Dict[str, SharedArrayHandle]] = {}
+        self._blocks: List[shared_memory.SharedMemory] = []
+        # frees the blocks if close() is never called
+        self._finalizer = weakref.finalize(self, _release_blocks, self._blocks)
+
+    def _add(self, acquisition_name: str, kind: str, X, read_into):
+        shape = tuple(X.obj.data.shape)
+        dtype = np.dtype(X.obj.data.dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        self._blocks.append(shm)
+        read_into(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        self.handles.setdefault(acquisition_name, {})[kind] = SharedArrayHandle(
+            name=shm.name, shape=shape, dtype=dtype.str, rate=float(X.rate), starting_time=float(X.starting_time)
+        )
+
+    @property
+    def num_bytes(self):
+        return sum(shm.size for shm in self._blocks)
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def attach_shared(handles: Dict[str, Dict[str, SharedArrayHandle]]):
+    # In a worker: the published arrays as read-only numpy views, with the
+    # same acquisition_name -> kind structure as the handles
+    return {a: {kind: h.attach() for kind, h in hh.items()} for a, hh in handles.items()}
+
+
+def detach_shared():
+    # In a worker: drop the attachments (the views must no longer be in use)
+    for name in list(_attached):
+        shm = _attached.pop(name)
+        try:
+            shm.close()
+        except BufferError:
+            # a view is still alive; the mapping goes away with the process
+            pass
+
+
+_attached: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _open_shared_memory(name: str):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def _release_blocks(blocks: List[shared_memory.SharedMemory]):
+    while blocks:
+        shm = blocks.pop()
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def publish_session_arrays(S, *, kinds: List[str], acquisition_names: Union[List[str], None] = None):
+    for kind in kinds:
+        if kind not in shared_kinds:
+            raise ValueError(f"Unexpected kind: {kind}")
+    if acquisition_names is None:
+        acquisition_names = S.get_acquisition_names()
+    published = SharedSessionArrays()
+    try:
+        for a in acquisition_names:
+            for kind in kinds:
+                if not S.has_series(a, kind):
+                    continue
+                if kind == "roi_responses":
+                    X = S.get_roi_response_series(a)
+                elif kind == "pupil_radius":
+                    X = S.get_pupil_radius(a)
+                elif kind == "two_photon":
+                    X = S.get_two_photon_series(a)
+                elif kind == "motion_corrected_two_photon":
+                    X = S.get_motion_corrected_two_photon_series(a)
+                else:
+                    X = S.get_pupil_video(a)
+                if hasattr(X, "get_frames"):
+                    published._add(a, kind, X, lambda out: X.get_frames(out=out))
+                else:
+                    published._add(a, kind, X, lambda out: X.get_data(out=out))
+    except BaseException:
+        published.close()
+        raise
+    return published
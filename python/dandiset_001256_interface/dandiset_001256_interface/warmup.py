@@ -0,0 +1,99 @@
+import os
+import time
+from typing import List, Union
+
+
+# Preloads sessions into a long-lived process (e.g. a Jupyter kernel that runs
+# a series of code cells): the sessions are opened with load_session, so later
+# load_session calls with the same nwb_url return them right away, and their
+# availability tables and the arrays of the given kinds are held in memory.
+# The availability tables and arrays are also saved in the cache directory,
+# and sessions of DANDI assets open from a local copy of their lindi file, so
+# warming up again after a kernel restart does not download them again (the
+# pynwb backend may still read a few small datasets from the remote file).
+#
+#   from dandiset_001256_interface import warmup
+#   report = warmup(sessions=["sub-AA0308_ses-20210414T173129"], kinds=["roi_responses", "pupil_radius"])
+
+
+def warmup(
+    sessions: Union[List[Union[str, dict]], str, dict, None] = None,
+    kinds: List[str] = ["roi_responses", "pupil_radius"],
+    *,
+    backend: str = "pynwb",
+    use_cache: bool = True,
+    verbose: bool = True
+):
+    # sessions are session ids, nwb urls or the session dicts of
+    # get_dandiset_info() (default: all the sessions of the dandiset).
+    # Returns a report of what was preloaded and how much memory it takes.
+    from .Session import load_session
+    from .preloaded_arrays import preload_kinds, preload_session_availability
+
+    for kind in kinds:
+        if kind not in preload_kinds:
+            raise ValueError(f"Unexpected kind: {kind}")
+    t0 = time.perf_counter()
+    session_list = _resolve_sessions(sessions)
+    report_sessions = []
+    for session in session_list:
+        t1 = time.perf_counter()
+        S = load_session(nwb_url=session["asset_url"], backend=backend)
+        availability_source = preload_session_availability(S, use_cache=use_cache)
+        arrays = S.preload(kinds, use_cache=use_cache)
+        report_sessions.append({
+            "session_id": session.get("session_id"),
+            "nwb_url": session["asset_url"],
+            "num_acquisitions": len(S.get_acquisition_names()),
+            "availability_source": availability_source,
+            "arrays": arrays,
+            "num_bytes": sum(x["num_bytes"] for x in arrays),
+            "elapsed_sec": time.perf_counter() - t1,
+        })
+        if verbose:
+            r = report_sessions[-1]
+            sources = sorted(set(x["source"] for x in arrays))
+            print(f"{r['session_id'] or r['nwb_url']}: {r['num_acquisitions']} acquisitions, {len(arrays)} arrays ({r['num_bytes'] / 1e6:.1f} MB from {', '.join(sources) or '-'}) in {r['elapsed_sec']:.1f} sec")
+    report = {
+        "sessions": report_sessions,
+        "num_arrays": sum(len(r["arrays"]) for r in report_sessions),
+        "num_bytes": sum(r["num_bytes"] for r in report_sessions),
+        "rss_bytes": _get_rss_bytes(),
+        "elapsed_sec": time.perf_counter() - t0,
+    }
+    if verbose:
+        rss = f", process resident memory {report['rss_bytes'] / 1e6:.1f} MB" if report["rss_bytes"] is not None else ""
+        print(f"Preloaded {len(report_sessions)} sessions and {report['num_arrays']} arrays ({report['num_bytes'] / 1e6:.1f} MB{rss}) in {report['elapsed_sec']:.1f} sec")
+    return report
+
+
+def _resolve_sessions(sessions: Union[List[Union[str, dict]], str, dict, None]):
+    # None stands for all the sessions of the dandiset
+    if sessions is None or isinstance(sessions, (str, dict)):
+        sessions = [sessions]
+    dandiset_sessions = None
+    ret = []
+    for s in sessions:
+        if isinstance(s, dict):
+            ret.append(s)
+        elif isinstance(s, str) and ("/" in s or s.endswith(".nwb") or s.endswith(".lindi.json")):
+            ret.append({"asset_url": s, "session_id": None})
+        else:
+            if dandiset_sessions is None:
+                from .get_dandiset_info import get_dandiset_info
+
+                dandiset_sessions = get_dandiset_info()["sessions"]
+            matches = [x for x in dandiset_sessions if s is None or x["session_id"] == s]
+            if not matches:
+                raise ValueError(f"Session not found: {s}")
+            ret.extend(matches)
+    return ret
+
+
+def _get_rss_bytes():
+    # Resident memory of this process (None where /proc is not available)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
@@ -57,6 +57,18 @@ print(f"Rate (Hz): {roi_response_series.rate}")
 print(f"Number of samples: {roi_response_series.num_samples}")
 print(f'Number of roi channels: {roi_response_series.num_channels}')
 print("")
+
+# Some series (for example pupil_radius for certain acquisitions) may be missing.
+# Check before loading, rather than catching exceptions:
+for acq_name in acquisition_names:
+    if not S.has_pupil_radius(acq_name):
+        print(f"Pupil radius is missing for acquisition {acq_name}")
+
+# Or get the availability, shapes, rates and starting times of all the series at once.
+# The keys for each acquisition are two_photon, motion_corrected_two_photon,
+# pupil_video, pupil_radius and roi_responses (None if missing).
+availability = S.get_availability()
+print(availability["000"]["roi_responses"])  # {"shape": [...], "rate": ..., "starting_time": ...}
 # %%
 
 # Here is the plot of all pupil radius data across all acquisitions, with the